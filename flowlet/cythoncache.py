@@ -0,0 +1,127 @@
+import os
+import sys
+import imp
+import fcntl
+import hashlib
+import inspect
+import platform
+import textwrap
+import tempfile
+import shutil
+
+# Cython Cache
+# ============
+
+# Functions compiled with Cython are kept as extension modules in a cache
+# directory, named after a hash of their source and module, the Cython
+# version and the interpreter ABI, so a function is only ever compiled
+# once for a given interpreter. Other processes use the same directory, a lock file
+# per module keeps them from building it at the same time.
+#
+# Cython refuses names it can't see declared, so the globals the function
+# uses are declared in the module and set to those of the original
+# function once it is loaded. The same source in another module has
+# other globals, and gets an extension module of its own.
+
+CACHE_DIR = os.environ.get('FLOWLET_CYTHON_CACHE',
+        os.path.join(os.path.expanduser('~'), '.cache', 'flowlet', 'cython'))
+
+# Loaded functions by module name, for this process
+loaded = {}
+
+def extension_suffix():
+    for suffix, _, kind in imp.get_suffixes():
+        if kind == imp.C_EXTENSION:
+            return suffix
+
+def global_names(f):
+    names = set()
+    codes = [f.func_code]
+    while codes:
+        code = codes.pop()
+        names.update(code.co_names)
+        codes.extend(c for c in code.co_consts if inspect.iscode(c))
+    return sorted(names.intersection(f.func_globals))
+
+def source_of(f):
+    lines = textwrap.dedent(inspect.getsource(f)).splitlines(True)
+    # Decorators are applied by the caller, not compiled in
+    while lines and lines[0].startswith('@'):
+        lines.pop(0)
+
+    declared = ['%s = None\n' % name for name in global_names(f)]
+    return ''.join(declared + lines)
+
+def module_name(source, module):
+    import cython
+
+    key = hashlib.sha1()
+    for part in (source, module, cython.__version__, sys.version,
+            platform.machine(), extension_suffix()):
+        key.update(part)
+        key.update('\0')
+    return '_flowlet_cython_' + key.hexdigest()
+
+def build(name, source, cache_dir):
+    from distutils.core import Distribution, Extension
+    from Cython.Build import cythonize
+
+    build_dir = tempfile.mkdtemp(dir=cache_dir)
+    try:
+        pyx = os.path.join(build_dir, name + '.pyx')
+        with open(pyx, 'w') as f:
+            f.write(source)
+
+        extensions = cythonize([Extension(name, [pyx])], quiet=True,
+                compiler_directives={'language_level': 2})
+
+        dist = Distribution({'ext_modules': extensions})
+        cmd = dist.get_command_obj('build_ext')
+        cmd.build_lib = build_dir
+        cmd.build_temp = build_dir
+        cmd.ensure_finalized()
+        cmd.run()
+
+        # Renamed into place so nobody ever loads a partly written module
+        built = os.path.join(build_dir, name + extension_suffix())
+        os.rename(built, os.path.join(cache_dir, name + extension_suffix()))
+    finally:
+        shutil.rmtree(build_dir, ignore_errors=True)
+
+def compiled(f, cache_dir=None):
+    """
+    ``f`` compiled with Cython, from the cache in ``cache_dir`` when it
+    has been compiled before.
+    """
+    cache_dir = cache_dir or CACHE_DIR
+    source = source_of(f)
+    name = module_name(source, f.__module__)
+
+    if name in loaded:
+        return loaded[name]
+
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # Made by another process in the meantime
+            if not os.path.isdir(cache_dir):
+                raise
+
+    path = os.path.join(cache_dir, name + extension_suffix())
+
+    if not os.path.exists(path):
+        with open(os.path.join(cache_dir, name + '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if not os.path.exists(path):
+                    build(name, source, cache_dir)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    module = imp.load_dynamic(name, path)
+    for key in global_names(f):
+        setattr(module, key, f.func_globals[key])
+
+    fn = loaded[name] = getattr(module, f.__name__)
+    return fn
@@ -21,7 +21,6 @@ typedef int Py_ssize_t;
 #define MODULE_NAME "flow"
 #define FLOWLET_ACCESSOR "flowlet"
 #define FLOWLET_NOOP Py_None
-#define FLOWLET_PARAM PyTuple_New(0)
 
 #define EmptyTuple(x) (PyTuple_CheckExact(x) && ((int)PyTuple_Size(x)) == 0)
 #define Py_FlowletCheck(ob) (((PyObject *) (ob))->ob_type == &flowlet_type)
@@ -33,10 +32,301 @@ typedef int Py_ssize_t;
 #   define TRACE()    ((void) 0)
 #endif
 
+#define FLOWLET_QUEUE_MINSIZE 8
+#define FLOWLET_FREELIST_SIZE 256
+#define FLOWLET_POOL_SIZE 256
+
 static PyTypeObject flowlet_type;
+
+// The empty argument tuple await() switches with, shared so the
+// await/switch path never allocates.
+static PyObject *FLOWLET_PARAM;
 static PyObject *PyExc_FlowletExit;
 static PyObject *PyExc_BlockedUpstream;
 
+// Passed across a switch in place of a value to mean "the values are
+// waiting in your queue", see send_many().
+static PyObject *FLOWLET_DRAIN;
+static PyObject *FLOWLET_DRAIN_ARGS;
+
+// Passed to the parent once an iterator source runs dry
+static PyObject *FLOWLET_EXHAUSTED;
+
+// The flowlet last known to be running, so that send() and await() can
+// find themselves without a dict lookup. Only trusted while its
+// greenlet is still the current one, see PyFlowlet_GetCurrent().
+static flowletobject *FLOWLET_CURRENT;
+
+// The shared entry point of every flowlet greenlet, see f_run()
+static PyObject *FLOWLET_RUNNER;
+
+static flowletobject *PyFlowlet_GetCurrent(void);
+static PyObject *send(PyObject *self, PyObject *args, PyObject *kwargs);
+
+// =======
+// Buffers
+// =======
+
+// Ring buffer of owned references, grows by doubling when full.
+
+static int
+fq_grow(flowletqueue *q, Py_ssize_t need)
+{
+    PyObject **items;
+    Py_ssize_t size = q->size ? q->size : FLOWLET_QUEUE_MINSIZE;
+    Py_ssize_t i;
+
+    while (size < need) {
+        size <<= 1;
+    }
+
+    items = PyMem_New(PyObject *, size);
+    if (items == NULL) {
+        PyErr_NoMemory();
+        return -1;
+    }
+
+    // Unwrap the ring so the live region starts at zero
+    for (i = 0; i < q->count; i++) {
+        items[i] = q->items[(q->head + i) % q->size];
+    }
+
+    PyMem_Free(q->items);
+    q->items = items;
+    q->head = 0;
+    q->size = size;
+    return 0;
+}
+
+static int
+fq_push(flowletqueue *q, PyObject *item)
+{
+    if (q->count == q->size && fq_grow(q, q->count + 1) < 0) {
+        return -1;
+    }
+
+    Py_INCREF(item);
+    q->items[(q->head + q->count) % q->size] = item;
+    q->count++;
+    return 0;
+}
+
+static int
+fq_extend(flowletqueue *q, PyObject *seq)
+{
+    Py_ssize_t i;
+    Py_ssize_t n = PySequence_Fast_GET_SIZE(seq);
+
+    if (q->count + n > q->size && fq_grow(q, q->count + n) < 0) {
+        return -1;
+    }
+
+    for (i = 0; i < n; i++) {
+        fq_push(q, PySequence_Fast_GET_ITEM(seq, i));
+    }
+    return 0;
+}
+
+// Returns a new reference, the caller must check count first
+static PyObject *
+fq_pop(flowletqueue *q)
+{
+    PyObject *item;
+
+    assert(q->count > 0);
+    item = q->items[q->head];
+    q->head = (q->head + 1) % q->size;
+    q->count--;
+    return item;
+}
+
+static void
+fq_clear(flowletqueue *q)
+{
+    while (q->count > 0) {
+        PyObject *item = fq_pop(q);
+        Py_DECREF(item);
+    }
+}
+
+static void
+fq_free(flowletqueue *q)
+{
+    fq_clear(q);
+    PyMem_Free(q->items);
+    q->items = NULL;
+    q->size = 0;
+}
+
+// Resolve the result of a context switch, replacing the drain marker
+// with the head of the queue it refers to.
+static PyObject *
+fq_receive(flowletqueue *q, PyObject *res)
+{
+    if (res != FLOWLET_DRAIN) {
+        return res;
+    }
+
+    Py_DECREF(res);
+    if (q->count == 0) {
+        PyErr_SetString(PyExc_RuntimeError, "Drained an empty buffer.");
+        return NULL;
+    }
+    return fq_pop(q);
+}
+
+static int
+fq_traverse(flowletqueue *q, visitproc visit, void *arg)
+{
+    Py_ssize_t i;
+
+    for (i = 0; i < q->count; i++) {
+        Py_VISIT(q->items[(q->head + i) % q->size]);
+    }
+    return 0;
+}
+
+// =====
+// Pools
+// =====
+
+// Short pipelines are built and torn down constantly, so dead flowlets
+// are kept on a freelist and their finished greenlets reset and reused
+// rather than handed back to the allocator.
+
+static flowletobject *free_flowlets[FLOWLET_FREELIST_SIZE];
+static int num_free_flowlets = 0;
+
+static PyGreenlet *free_greenlets[FLOWLET_POOL_SIZE];
+static int num_free_greenlets = 0;
+
+// Resetting a finished greenlet means writing to fields of its struct
+// which are private to greenlet, laid out as in this release. With any
+// other greenlet, at build time or at run time, greenlets are not pooled.
+#define FLOWLET_GREENLET_LAYOUT "0.4.17"
+static int greenlet_pooling = 0;
+
+static Py_ssize_t flowlet_hits = 0;
+static Py_ssize_t flowlet_misses = 0;
+static Py_ssize_t greenlet_hits = 0;
+static Py_ssize_t greenlet_misses = 0;
+
+// Whether greenlet, both the header we were built against and the module
+// loaded, is the release whose layout f_recycle() knows
+static int
+f_greenlet_layout(void)
+{
+    PyObject *mod;
+    PyObject *version = NULL;
+    int same = 0;
+
+    if (strcmp(GREENLET_VERSION, FLOWLET_GREENLET_LAYOUT) != 0) {
+        return 0;
+    }
+
+    mod = PyImport_ImportModule("greenlet");
+    if (mod != NULL) {
+        version = PyObject_GetAttrString(mod, "__version__");
+    }
+    if (version != NULL && PyString_Check(version)) {
+        same = strcmp(PyString_AS_STRING(version), FLOWLET_GREENLET_LAYOUT) == 0;
+    }
+
+    PyErr_Clear();
+    Py_XDECREF(version);
+    Py_XDECREF(mod);
+    return same;
+}
+
+static flowletobject *
+f_alloc(PyTypeObject *type)
+{
+    flowletobject *fl;
+
+    if (type != &flowlet_type || num_free_flowlets == 0) {
+        if (type == &flowlet_type) {
+            flowlet_misses++;
+        }
+        return (flowletobject *)type->tp_alloc(type, 0);
+    }
+
+    flowlet_hits++;
+    fl = free_flowlets[--num_free_flowlets];
+    memset(fl, 0, sizeof(flowletobject));
+    PyObject_INIT(fl, type);
+    return fl;
+}
+
+static void
+f_free(flowletobject *fl)
+{
+    if (Py_TYPE(fl) == &flowlet_type && num_free_flowlets < FLOWLET_FREELIST_SIZE) {
+        free_flowlets[num_free_flowlets++] = fl;
+    } else {
+        Py_TYPE(fl)->tp_free((PyObject *)fl);
+    }
+}
+
+// A new unstarted greenlet which will enter f_run(), with an empty dict
+static PyGreenlet *
+f_greenlet(void)
+{
+    PyGreenlet *g;
+
+    if (num_free_greenlets > 0) {
+        greenlet_hits++;
+        return free_greenlets[--num_free_greenlets];
+    }
+
+    greenlet_misses++;
+    g = PyGreenlet_New(FLOWLET_RUNNER, NULL);
+    if (g == NULL) {
+        return NULL;
+    }
+
+    g->dict = PyDict_New();
+    if (g->dict == NULL) {
+        Py_DECREF(g);
+        return NULL;
+    }
+    return g;
+}
+
+// Takes over the reference to g. A greenlet that nobody else holds and
+// that is not suspended mid-run is put back into its unstarted state,
+// anything else is simply released.
+static void
+f_recycle(PyGreenlet *g)
+{
+    if (!greenlet_pooling ||
+        Py_REFCNT(g) != 1 || PyGreenlet_ACTIVE(g) || g->weakreflist != NULL ||
+        g->stack_copy != NULL || num_free_greenlets == FLOWLET_POOL_SIZE) {
+        Py_DECREF(g);
+        return;
+    }
+
+    // Once started the greenlet keeps its thread state in run_info
+    if (g->run_info != FLOWLET_RUNNER) {
+        Py_XDECREF(g->run_info);
+        Py_INCREF(FLOWLET_RUNNER);
+        g->run_info = FLOWLET_RUNNER;
+    }
+
+    Py_CLEAR(g->parent);
+    Py_CLEAR(g->exc_type);
+    Py_CLEAR(g->exc_value);
+    Py_CLEAR(g->exc_traceback);
+
+    g->stack_start = NULL;
+    g->stack_stop = NULL;
+    g->stack_saved = 0;
+    g->stack_prev = NULL;
+    g->top_frame = NULL;
+    g->recursion_depth = 0;
+
+    free_greenlets[num_free_greenlets++] = g;
+}
+
 // ===========================
 // Low level context switching
 // ===========================
@@ -52,15 +342,19 @@ f_switch(flowletobject *target, PyObject *args, PyObject *kwargs, unsigned short
 
     if (target->started == 1 && !PyGreenlet_ACTIVE(target->gr)) {
         PyErr_SetString(PyExc_RuntimeError, "Dead");
-        Py_XDECREF(args);
-        Py_XDECREF(kwargs);
         return NULL;
     }
 
     // Deferred argument passing from the constructor
     if (target->started == 0 && sending) {
         target->started = 1;
-        PyGreenlet_Switch(target->gr, target->args, target->kwargs);
+        res = PyGreenlet_Switch(target->gr, target->args, target->kwargs);
+        // A logic that cannot be started with its constructor arguments
+        // is dead already, the values then just bounce back to us
+        if (res == NULL) {
+            PyErr_Clear();
+        }
+        Py_XDECREF(res);
         res = PyGreenlet_Switch(target->gr, args, kwargs);
     } else if (target->started == 0 && !sending) {
         target->started = 1;
@@ -88,6 +382,9 @@ flowlet_switch(flowletobject *self, PyObject *args, PyObject *kwargs)
 #endif
 
     state = f_switch(self, args, kwargs, sending);
+    if (state != NULL) {
+        state = fq_receive(&self->outbox, state);
+    }
     if (state == NULL) {
         // Shouldn't happen, but it can if you muck with the stack frames at runtime
         if (!PyErr_Occurred()) {
@@ -108,7 +405,11 @@ flowlet_switch(flowletobject *self, PyObject *args, PyObject *kwargs)
 static void
 f_reflow(flowletobject *first, flowletobject *second)
 {
+    PyGreenlet *parent = second->gr->parent;
+
+    Py_INCREF(first->gr);
     second->gr->parent = first->gr;
+    Py_XDECREF(parent);
 }
 
 // +---+      +---+   +---+   +---+   +---+
@@ -153,6 +454,123 @@ f_lroll(flowletobject *a, PyObject *stack)
     }
 }
 
+// Pull the next value from the iterator a flowlet is bound to, returns
+// NULL with no exception set once it is exhausted.
+static PyObject *
+f_pull(flowletobject *fl)
+{
+    PyObject *it;
+    PyObject *res;
+
+    if (!fl->iter) {
+        it = PyObject_GetIter(fl->source);
+        if (it == NULL) {
+            return NULL;
+        }
+        Py_DECREF(fl->source);
+        fl->source = it;
+        fl->iter = 1;
+    }
+
+    // The source may be released while it runs, when it reads from a
+    // flowlet which switches away and the pipeline is torn down
+    it = fl->source;
+    Py_INCREF(it);
+    res = PyIter_Next(it);
+    Py_DECREF(it);
+    return res;
+}
+
+// Hand over the values run ahead into the buffer downstream, once the
+// stream into fl is done and nothing will fill it up any more
+static int
+f_flush(flowletobject *fl)
+{
+    while (fl->down != NULL && fl->down->inbox.count > 0) {
+        PyObject *sent = send(NULL, FLOWLET_DRAIN_ARGS, NULL);
+        if (sent == NULL) {
+            return -1;
+        }
+        Py_DECREF(sent);
+    }
+    return 0;
+}
+
+// Every flowlet greenlet starts here rather than in its logic, so that
+// values the logic left buffered downstream are handed over when it
+// returns instead of being lost along with the greenlet.
+static PyObject *
+f_run(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+    PyObject *res;
+    flowletobject *fl = PyFlowlet_GetCurrent();
+
+    if (fl == NULL) {
+        if (!PyErr_Occurred()) {
+            PyErr_SetString(PyExc_RuntimeError, "run() only usable within flowlet stack");
+        }
+        return NULL;
+    }
+
+    res = PyObject_Call(fl->run, args, kwargs);
+    if (res == NULL) {
+        return NULL;
+    }
+
+    // The flowlet may have been released while its logic ran
+    fl = PyFlowlet_GetCurrent();
+    if (fl == NULL) {
+        PyErr_Clear();
+        return res;
+    }
+
+    if (f_flush(fl) < 0) {
+        Py_DECREF(res);
+        return NULL;
+    }
+
+    return res;
+}
+
+static PyMethodDef f_run_def = {
+    "run", (PyCFunction)f_run, METH_VARARGS | METH_KEYWORDS, NULL
+};
+
+// Detach a flowlet from whatever it reads from
+static void
+f_unbind(flowletobject *fl)
+{
+    Py_CLEAR(fl->source);
+    if (fl->up != NULL) {
+        fl->up->down = NULL;
+        Py_CLEAR(fl->up);
+    }
+}
+
+// Give a flowlet the unstarted greenlet g, created under the current one
+static int
+f_attach(flowletobject *fl, PyGreenlet *g)
+{
+    PyGreenlet *parent;
+    PyObject *accessor;
+
+    parent = PyGreenlet_GetCurrent();
+    PyGreenlet_SetParent(g, parent);
+    Py_DECREF(parent);
+
+    // The greenlet only borrows its flowlet, a strong reference here
+    // would make every flowlet immortal
+    accessor = PyCapsule_New(fl, NULL, NULL);
+    if (accessor == NULL || PyDict_SetItemString(g->dict, FLOWLET_ACCESSOR, accessor) < 0) {
+        Py_XDECREF(accessor);
+        return -1;
+    }
+    Py_DECREF(accessor);
+
+    fl->gr = g;
+    return 0;
+}
+
 static PyObject *
 flowlet_new(PyTypeObject *type, PyObject *args, PyObject *kwargs)
 {
@@ -166,47 +584,40 @@ flowlet_new(PyTypeObject *type, PyObject *args, PyObject *kwargs)
         return NULL;
     }
 
-    fl = (flowletobject *)type->tp_alloc(type, 0);
-    if (fl == NULL) {
+    run = PyTuple_GET_ITEM(args, 0);
+
+    if (!PyCallable_Check(run)) {
+        PyErr_SetString(PyExc_TypeError, "argument to 'run' is not callable");
         return NULL;
     }
 
-    run = PyTuple_GET_ITEM(args, 0);
+    fl = f_alloc(type);
+    if (fl == NULL) {
+        return NULL;
+    }
 
+    Py_INCREF(run);
     fl->run = run;
     fl->args = PyTuple_GetSlice(args, 1, INT_MAX);
     fl->kwargs = kwargs;
+    Py_XINCREF(kwargs);
     fl->terminal = 1;
     fl->initial = 1;
+    fl->saturated = Py_None;
+    fl->pending = 0;
 
-    g = (PyGreenlet *) PyType_GenericAlloc(&PyGreenlet_Type, 0);
-#ifdef DEBUG
+    g = f_greenlet();
     if (g == NULL) {
+        Py_DECREF(fl);
         return NULL;
     }
-#endif
 
-    if (!PyCallable_Check(run)) {
-        PyErr_SetString(PyExc_TypeError, "argument to 'run' is not callable");
+    if (f_attach(fl, g) < 0) {
+        Py_DECREF(g);
+        Py_DECREF(fl);
         return NULL;
     }
 
-    fl->gr = g;
-    fl->saturated = Py_None;
-    fl->pending = 0;
-
-    PyGreenlet *parent = PyGreenlet_GetCurrent();
-    PyGreenlet_SetParent(g, parent);
-
-    g->dict = PyDict_New();
-    Py_INCREF(g->dict);
-
-    if (run != NULL) {
-        Py_INCREF(run);
-        g->run_info = run;
-    }
-    PyDict_SetItemString(g->dict, FLOWLET_ACCESSOR, (PyObject *)fl);
-
     return (PyObject *)fl;
 }
 
@@ -217,10 +628,45 @@ flowlet_new(PyTypeObject *type, PyObject *args, PyObject *kwargs)
 static void
 flowlet_dealloc(flowletobject *self)
 {
-    Py_XDECREF(self->gr);
-    Py_XDECREF(self->up);
-    Py_XDECREF(self->down);
-    Py_CLEAR(self->gr);
+    PyGreenlet *g = self->gr;
+
+    if (FLOWLET_CURRENT == self) {
+        FLOWLET_CURRENT = NULL;
+    }
+
+    // Unregister first, releasing a greenlet that is suspended mid-run
+    // unwinds it and that must not find its way back to us
+    if (g != NULL) {
+        self->gr = NULL;
+        PyDict_Clear(g->dict);
+    }
+
+    // Upstream goes first since after a reflow its greenlet holds ours
+    // as its parent, which would keep ours out of the pool
+    if (self->up != NULL) {
+        self->up->down = NULL;
+        Py_CLEAR(self->up);
+    }
+
+    if (g != NULL) {
+        f_recycle(g);
+    }
+
+    if (FLOWLET_CURRENT == self) {
+        FLOWLET_CURRENT = NULL;
+    }
+
+    // An iterator source goes last, once our greenlet has unwound out of
+    // any frame still iterating it
+    Py_CLEAR(self->run);
+    Py_CLEAR(self->args);
+    Py_CLEAR(self->kwargs);
+    Py_CLEAR(self->value);
+    Py_CLEAR(self->source);
+    fq_free(&self->inbox);
+    fq_free(&self->outbox);
+
+    f_free(self);
 }
 
 static int
@@ -232,6 +678,9 @@ flowlet_traverse(PyObject *self, visitproc visit, void *arg)
     Py_VISIT(fl->gr);
     Py_VISIT(fl->up);
     Py_VISIT(fl->down);
+    Py_VISIT(fl->source);
+    fq_traverse(&fl->inbox, visit, arg);
+    fq_traverse(&fl->outbox, visit, arg);
     return 0;
 }
 
@@ -279,13 +728,43 @@ flowlet_getvalue(flowletobject *self, void *c)
 {
     PyObject *result = self->value;
     if (self->value == NULL) {
-        return Py_None;
+        Py_RETURN_NONE;
     } else {
         Py_INCREF(result);
         return result;
     }
 }
 
+static PyObject *
+flowlet_getbuffer(flowletobject *self, void *c)
+{
+    return PyInt_FromSsize_t(self->bufsize);
+}
+
+static int
+flowlet_setbuffer(flowletobject *self, PyObject *value, void *c)
+{
+    Py_ssize_t n;
+
+    if (value == NULL) {
+        PyErr_SetString(PyExc_TypeError, "Cannot delete buffer.");
+        return -1;
+    }
+
+    n = PyNumber_AsSsize_t(value, PyExc_OverflowError);
+    if (n == -1 && PyErr_Occurred()) {
+        return -1;
+    }
+
+    if (n < 0) {
+        PyErr_SetString(PyExc_ValueError, "buffer must be non-negative");
+        return -1;
+    }
+
+    self->bufsize = n;
+    return 0;
+}
+
 static PyObject *
 flowlet_getargs(flowletobject *self, void *c)
 {
@@ -308,9 +787,9 @@ static PyObject *
 flowlet_getactive(flowletobject *self, PyObject *args, PyObject **kwargs)
 {
     if (PyGreenlet_ACTIVE(self) && PyGreenlet_STARTED(self)) {
-        return Py_True;
+        Py_RETURN_TRUE;
     } else {
-        return Py_False;
+        Py_RETURN_FALSE;
     }
 }
 
@@ -319,6 +798,7 @@ static PyGetSetDef flowlet_getsets[] = {
     {"args"      , (getter)flowlet_getargs      , NULL , NULL} ,
     {"kwargs"    , (getter)flowlet_getkwargs    , NULL , NULL} ,
     {"active"    , (getter)flowlet_getactive    , NULL , NULL} ,
+    {"buffer"    , (getter)flowlet_getbuffer    , (setter)flowlet_setbuffer , NULL} ,
 #if DEBUG
     {"greenlet"  , (getter)flowlet_getgreenlet  , NULL , NULL} ,
     {"up"        , (getter)flowlet_getup        , NULL , NULL} ,
@@ -351,22 +831,27 @@ flowlet_send(flowletobject *self, PyObject *args, PyObject *kwargs)
         return NULL;
     }
 
-    Py_INCREF(args);
-    Py_XINCREF(args);
-
     result = f_switch(self, args, NULL, 1);
 
-    if (PyErr_Occurred()) {
+    if (result == NULL || PyErr_Occurred()) {
+        Py_XDECREF(result);
         return NULL;
     }
 
-    if (result != NULL && !EmptyTuple(result)) {
+    result = fq_receive(&self->outbox, result);
+    if (result == NULL) {
+        return NULL;
+    }
+
+    if (!EmptyTuple(result)) {
+        Py_XDECREF(self->value);
         self->pending = 1;
         self->value = result;
+    } else {
+        Py_DECREF(result);
     }
 
-    /*assert(result!=NULL);*/
-    return Py_None;
+    Py_RETURN_NONE;
 }
 
 // f.await()
@@ -394,32 +879,151 @@ flowlet_await(flowletobject *self)
         assert(self->value != NULL);
         self->pending = 0;
 
+        Py_INCREF(self->value);
         return self->value;
     } else {
         Py_CLEAR(self->value);
     }
 
+    // Drain anything a terminal send_many() left behind
+    if (self->outbox.count > 0) {
+        return fq_pop(&self->outbox);
+    }
+
     result = f_switch(self, NULL, NULL, 0);
 
-    if (PyErr_Occurred()) {
+    if (result == NULL || PyErr_Occurred()) {
+        Py_XDECREF(result);
         return NULL;
     }
 
+    result = fq_receive(&self->outbox, result);
+
     assert(result != NULL);
     /*assert (!EmptyTuple(result));*/
 
     return result;
 }
 
+// f.send_many()
+static PyObject *
+flowlet_send_many(flowletobject *self, PyObject *args)
+{
+    PyObject *items;
+    PyObject *seq;
+    PyObject *result;
+
+    if (!PyArg_UnpackTuple(args, "send_many", 1, 1, &items)) {
+        return NULL;
+    }
+
+    seq = PySequence_Fast(items, "send_many() argument must be iterable");
+    if (seq == NULL) {
+        return NULL;
+    }
+
+    if (PySequence_Fast_GET_SIZE(seq) == 0) {
+        Py_DECREF(seq);
+        Py_RETURN_NONE;
+    }
+
+    if (fq_extend(&self->inbox, seq) < 0) {
+        Py_DECREF(seq);
+        return NULL;
+    }
+    Py_DECREF(seq);
+
+    if (self->started) {
+        return flowlet_send(self, FLOWLET_DRAIN_ARGS, NULL);
+    }
+
+    // Not yet running, so start it and let its await() drain the inbox
+    result = f_switch(self, NULL, NULL, 0);
+    if (result == NULL) {
+        return NULL;
+    }
+
+    result = fq_receive(&self->outbox, result);
+    if (result == NULL) {
+        return NULL;
+    }
+
+    if (!EmptyTuple(result)) {
+        Py_XDECREF(self->value);
+        self->pending = 1;
+        self->value = result;
+    } else {
+        Py_DECREF(result);
+    }
+    Py_RETURN_NONE;
+}
+
+// f.await_many()
+static PyObject *
+flowlet_await_many(flowletobject *self, PyObject *args)
+{
+    Py_ssize_t n;
+    PyObject *result;
+    PyObject *item;
+
+    if (!PyArg_ParseTuple(args, "n:await_many", &n)) {
+        return NULL;
+    }
+
+    if (n < 1) {
+        PyErr_SetString(PyExc_ValueError, "await_many() needs a positive count");
+        return NULL;
+    }
+
+    item = flowlet_await(self);
+    if (item == NULL) {
+        return NULL;
+    }
+
+    result = PyList_New(0);
+    if (result == NULL || PyList_Append(result, item) < 0) {
+        Py_DECREF(item);
+        Py_XDECREF(result);
+        return NULL;
+    }
+    Py_DECREF(item);
+
+    while (PyList_GET_SIZE(result) < n && self->outbox.count > 0) {
+        item = fq_pop(&self->outbox);
+        if (PyList_Append(result, item) < 0) {
+            Py_DECREF(item);
+            Py_DECREF(result);
+            return NULL;
+        }
+        Py_DECREF(item);
+    }
+
+    return result;
+}
+
 static PyObject *
 flowlet_final(flowletobject *self)
 {
     PyObject *typ = PyExc_GreenletExit;
+    PyObject *res;
     Py_CLEAR(self->value);
+    fq_clear(&self->inbox);
+    fq_clear(&self->outbox);
 
     if (self->up != NULL) {
         f_reflow(self, self->up);
-        flowlet_final(self->up);
+        res = flowlet_final(self->up);
+        Py_XDECREF(res);
+    }
+
+    // Reading from an iterator, await() gives None first just as it
+    // would once a finished upstream flowlet is finalized
+    if (self->up == NULL && self->source != NULL) {
+        Py_CLEAR(self->source);
+        if (self->gr != NULL && PyGreenlet_ACTIVE(self->gr)) {
+            res = PyGreenlet_Switch(self->gr, FLOWLET_EXHAUSTED, NULL);
+            Py_XDECREF(res);
+        }
     }
 
     if (self->gr == NULL) {
@@ -427,13 +1031,15 @@ flowlet_final(flowletobject *self)
         return NULL;
     }
 
-    PyGreenlet_Throw(self->gr, typ, NULL, NULL);
-    return Py_True;
+    res = PyGreenlet_Throw(self->gr, typ, NULL, NULL);
+    Py_XDECREF(res);
+    Py_RETURN_TRUE;
 }
 
 static PyObject *
 flowlet_resume(flowletobject *self)
 {
+    PyObject *res;
 
     if (self->suspended == 0) {
         PyErr_SetString(PyExc_ValueError, "Not Suspended");
@@ -441,8 +1047,12 @@ flowlet_resume(flowletobject *self)
     }
 
     self->suspended = 0;
-    PyGreenlet_Switch(self->gr, NULL, NULL);
-    return Py_None;
+    res = PyGreenlet_Switch(self->gr, NULL, NULL);
+    if (res == NULL) {
+        return NULL;
+    }
+    Py_DECREF(res);
+    Py_RETURN_NONE;
 }
 
 static PyObject *
@@ -456,11 +1066,12 @@ flowlet_iternext(flowletobject *self)
     }
 
     if (result == FLOWLET_NOOP) {
+        Py_DECREF(result);
         PyErr_SetNone(PyExc_StopIteration);
-        flowlet_final(self);
+        result = flowlet_final(self);
+        Py_XDECREF(result);
         return NULL;
     } else {
-        Py_INCREF(result);
         return result;
     }
 }
@@ -479,12 +1090,17 @@ flowlet_bind(flowletobject *self, PyObject *args, PyObject **kwargs)
         return NULL;
     }
 
-    if (Py_TYPE(up) == &flowlet_type) {
-        fup = up;
-    } else {
-        PyErr_SetString(PyExc_TypeError, "Not flowlet.");
-        return NULL;
+    // Any other iterable becomes the source of this flowlet, there is
+    // no upstream greenlet to switch to
+    if (Py_TYPE(up) != &flowlet_type) {
+        Py_INCREF(up);
+        f_unbind(self);
+        self->source = (PyObject *)up;
+        self->iter = 0;
+        self->initial = 0;
+        Py_RETURN_NONE;
     }
+    fup = up;
 
     fup->initial = 1;
     self->initial = 0;
@@ -492,11 +1108,64 @@ flowlet_bind(flowletobject *self, PyObject *args, PyObject **kwargs)
     fup->terminal = 0;
     self->terminal = 1;
 
+    // Downstream keeps upstream alive, the way back is borrowed
+    Py_INCREF(fup);
+    f_unbind(self);
     self->up = fup;
     fup->down  = self;
 
     // TODO: should this be a new flowlet?
-    return Py_None;
+    Py_RETURN_NONE;
+}
+
+// f.reset(), put a flowlet back into its unstarted state so that the
+// same wired up stages can be run again. Keeps the bindings.
+static PyObject *
+flowlet_reset(flowletobject *self)
+{
+    PyGreenlet *g = self->gr;
+    PyGreenlet *current = PyGreenlet_GetCurrent();
+
+    Py_DECREF(current);
+    if (g == current) {
+        PyErr_SetString(PyExc_RuntimeError, "Cannot reset a running flowlet.");
+        return NULL;
+    }
+
+    // Hand the greenlet back first, so that the one we take is most
+    // likely the very same
+    self->gr = NULL;
+    PyDict_Clear(g->dict);
+    f_recycle(g);
+
+    g = f_greenlet();
+    if (g == NULL) {
+        return NULL;
+    }
+
+    if (f_attach(self, g) < 0) {
+        Py_DECREF(g);
+        return NULL;
+    }
+
+    if (FLOWLET_CURRENT == self) {
+        FLOWLET_CURRENT = NULL;
+    }
+
+    Py_CLEAR(self->value);
+    fq_clear(&self->inbox);
+    fq_clear(&self->outbox);
+
+    self->saturated = Py_None;
+    self->pending = 0;
+    self->suspended = 0;
+    self->started = 0;
+    self->finalized = 0;
+
+    // An iterator source has been consumed, it needs rebinding
+    Py_CLEAR(self->source);
+
+    Py_RETURN_NONE;
 }
 
 static PyObject *
@@ -514,28 +1183,40 @@ flowlet_frame(flowletobject *self)
     // Weirdness because PyFunction_GetCode doesn't actually get a
     // PyCodeObject, but whatever we just need it for pointer
     // arithmetic anyways
+    // The frame is handed out as a new reference, a pooled greenlet
+    // drops its own when it is recycled
     stackframe = self->gr->top_frame;
-    fcode = stackframe->f_code;
     while (stackframe != NULL) {
+        fcode = (PyObject *)stackframe->f_code;
         if (!(fcode - code)) {
-            return stackframe;
+            Py_INCREF(stackframe);
+            return (PyObject *)stackframe;
         }
 
         stackframe = stackframe->f_back;
-        fcode = stackframe->f_code;
     }
 
-    return Py_None;
+    Py_RETURN_NONE;
 }
 
-// TODO: gcc keeps bitching about something in here
 static PyObject *
 flowlet_opcode(flowletobject *self)
 {
-    PyFrameObject *stackframe = flowlet_frame(self);
-    PyObject *code = stackframe->f_code->co_code;
-    Py_ssize_t instruction = stackframe->f_lasti;
-    return PySequence_GetSlice(code, instruction, PySequence_Length(code));
+    PyObject *result;
+    PyObject *code;
+    PyFrameObject *stackframe = (PyFrameObject *)flowlet_frame(self);
+
+    if (stackframe == NULL) {
+        return NULL;
+    }
+    if ((PyObject *)stackframe == Py_None) {
+        return (PyObject *)stackframe;
+    }
+
+    code = stackframe->f_code->co_code;
+    result = PySequence_GetSlice(code, stackframe->f_lasti, PySequence_Length(code));
+    Py_DECREF(stackframe);
+    return result;
 }
 
 static PyNumberMethods flowlet_operators = {
@@ -555,10 +1236,13 @@ static PyNumberMethods flowlet_operators = {
 static PyMethodDef flowlet_methods[] = {
     {"send"   , (PyCFunction)flowlet_send   , METH_VARARGS                 , NULL}  ,
     {"await"  , (PyCFunction)flowlet_await  , METH_NOARGS                  , NULL}  ,
+    {"send_many"  , (PyCFunction)flowlet_send_many  , METH_VARARGS         , NULL}  ,
+    {"await_many" , (PyCFunction)flowlet_await_many , METH_VARARGS         , NULL}  ,
     {"final"  , (PyCFunction)flowlet_final  , METH_NOARGS                  , NULL}  ,
     {"resume" , (PyCFunction)flowlet_resume , METH_NOARGS                  , NULL}  ,
     {"switch" , (PyCFunction)flowlet_switch , METH_VARARGS | METH_KEYWORDS , NULL} ,
     {"bind"   , (PyCFunction)flowlet_bind   , METH_VARARGS | METH_KEYWORDS , NULL}  ,
+    {"reset"  , (PyCFunction)flowlet_reset  , METH_NOARGS                  , NULL}  ,
     {"frame"  , (PyCFunction)flowlet_frame  , METH_NOARGS                  , NULL}  ,
     {"opcode" , (PyCFunction)flowlet_opcode , METH_NOARGS                  , NULL}  ,
     {NULL,      NULL}
@@ -603,24 +1287,40 @@ static PyTypeObject flowlet_type = {
     0,                           /* tp_init */
     0,                           /* tp_alloc */
     flowlet_new,                 /* tp_new */
-    PyObject_GC_Del,             /* tp_free */
+    PyObject_Del,                /* tp_free */
 };
 
 static flowletobject *
 PyFlowlet_GetCurrent()
 {
     flowletobject *fl;
+    PyObject *accessor;
     PyGreenlet *gr = PyGreenlet_GetCurrent();
 
+    // The current greenlet is kept alive by the running stack, so
+    // there is no need to hold on to the reference
+    Py_DECREF(gr);
+
+    if (FLOWLET_CURRENT != NULL && FLOWLET_CURRENT->gr == gr) {
+        return FLOWLET_CURRENT;
+    }
+
     if (gr->dict == NULL) {
         PyErr_SetString(PyExc_RuntimeError, "getcurrent() only usable within flowlet stack");
         return NULL;
     }
 
-    fl = (flowletobject *)PyDict_GetItemString(gr->dict, FLOWLET_ACCESSOR);
-    if (fl == NULL || PyErr_Occurred()) {
+    accessor = PyDict_GetItemString(gr->dict, FLOWLET_ACCESSOR);
+    if (accessor == NULL || PyErr_Occurred()) {
         return NULL;
     }
+
+    fl = (flowletobject *)PyCapsule_GetPointer(accessor, NULL);
+    if (fl == NULL) {
+        return NULL;
+    }
+
+    FLOWLET_CURRENT = fl;
     return fl;
 }
 
@@ -648,16 +1348,44 @@ await(PyObject *self, PyObject *arg)
 
     fl->saturated = Py_False;
 
+    // Values delivered in bulk by send_many() need no switch
+    if (fl->inbox.count > 0) {
+        return fq_pop(&fl->inbox);
+    }
+
     if (fl->initial && fl->terminal) {
         res = PyGreenlet_Switch(fl->gr->parent, FLOWLET_PARAM, NULL);
     } else if (fl->up != NULL) {
         res = f_switch(fl->up, FLOWLET_PARAM, NULL, 0);
+    } else if (fl->source != NULL) {
+        res = f_pull(fl);
+        if (res != NULL || PyErr_Occurred()) {
+            return res;
+        }
+        // Exhausted, hand control back just as a finished upstream
+        // greenlet would, flowlet_final() resumes us with None. What we
+        // ran ahead with downstream goes first.
+        if (f_flush(fl) < 0) {
+            return NULL;
+        }
+        res = PyGreenlet_Switch(fl->gr->parent, FLOWLET_EXHAUSTED, NULL);
+        FLOWLET_CURRENT = fl;
+        return res;
     } else {
         PyErr_SetNone(PyExc_BlockedUpstream);
         return NULL;
     }
 
-    if (PyErr_Occurred() && Py_FlowletFinalizing()) {
+    // Whoever switched back into us left their own flowlet cached
+    FLOWLET_CURRENT = fl;
+
+    if (res != NULL) {
+        res = fq_receive(&fl->inbox, res);
+    }
+
+    // A GreenletExit left over from finalizing upstream is stale once we
+    // have a value, if we have none it is ours and unwinds our logic
+    if (res != NULL && PyErr_Occurred() && Py_FlowletFinalizing()) {
         PyErr_Clear();
     }
 
@@ -667,32 +1395,46 @@ await(PyObject *self, PyObject *arg)
 static PyObject *
 f_close(PyObject *self)
 {
+    PyObject *res;
     flowletobject *fl = PyFlowlet_GetCurrent();
 
     if (fl == NULL) {
         PyErr_SetString(PyExc_RuntimeError, "close() only usable within flowlet stack");
+        return NULL;
     }
 
+    // Anything still buffered from upstream is discarded
+    fq_clear(&fl->inbox);
+
     // Never connected to anything, so easy
     if (fl->initial && fl->terminal) {
         PyGreenlet_Throw(fl->gr, PyExc_FlowletExit, NULL, NULL);
         return NULL;
     }
 
+    // Fed from an iterator, nothing upstream to unwind
+    if (fl->up == NULL) {
+        Py_CLEAR(fl->source);
+        Py_RETURN_TRUE;
+    }
+
     // Upstream never initialized, so easy
     if(fl->up->gr == NULL) {
-        return Py_False;
+        Py_RETURN_FALSE;
     }
 
     // Upstream started but never ran, so easy
     if (!PyGreenlet_ACTIVE(fl->up->gr)) {
+        fl->up->down = NULL;
         Py_CLEAR(fl->up);
-        return Py_False;
+        Py_RETURN_FALSE;
     }
 
     // We have a complicated stack to unwind upstream, so hard
     f_reflow(fl, fl->up);
-    flowlet_final(fl->up);
+    res = flowlet_final(fl->up);
+    Py_XDECREF(res);
+    fl->up->down = NULL;
     Py_CLEAR(fl->up);
 
     // Don't handle exceptions in the normal Python waybecause we're
@@ -701,13 +1443,14 @@ f_close(PyObject *self)
     if (PyErr_Occurred() && Py_FlowletFinalizing()) {
         PyErr_Clear();
     }
-    return Py_True;
+    Py_RETURN_TRUE;
 }
 
 static PyObject *
 send(PyObject *self, PyObject *args, PyObject *kwargs)
 {
     int i;
+    PyObject *res;
     PyFrameObject *f = PyEval_GetFrame();
 
     if (PyErr_Occurred()) {
@@ -715,24 +1458,48 @@ send(PyObject *self, PyObject *args, PyObject *kwargs)
     }
 
     flowletobject *fl = PyFlowlet_GetCurrent();
-    //assert(fl != NULL);
+
+    if (fl == NULL) {
+        if (!PyErr_Occurred()) {
+            PyErr_SetString(PyExc_RuntimeError, "send() only usable within flowlet stack");
+        }
+        return NULL;
+    }
 
     fl->saturated = Py_True;
-    Py_XINCREF(args);
+
+    // Run ahead while the consumer still has room in its buffer, once
+    // full hand over the whole buffer with a single switch
+    if (fl->down != NULL && fl->down->bufsize > 1 && fl->down->started &&
+        args != FLOWLET_DRAIN_ARGS) {
+        flowletqueue *q = &fl->down->inbox;
+        PyObject *value = PyTuple_GET_SIZE(args) == 1 ? PyTuple_GET_ITEM(args, 0) : args;
+
+        if (fq_push(q, value) < 0) {
+            return NULL;
+        }
+
+        if (q->count < fl->down->bufsize) {
+            Py_RETURN_NONE;
+        }
+        args = FLOWLET_DRAIN_ARGS;
+    }
 
     // Implictly forces any side-effects that are placed in the
     // arguments, i.e. socket.recv() or raw_input() calls would
     // be evaluated before performing context_switching
     if (fl->down == NULL) {
-        PyGreenlet_Switch(fl->gr->parent, args, NULL);
+        res = PyGreenlet_Switch(fl->gr->parent, args, NULL);
     } else {
-        f_switch(fl->down, args, NULL, 1);
+        res = f_switch(fl->down, args, NULL, 1);
     }
+    Py_XDECREF(res);
+    FLOWLET_CURRENT = fl;
 
     if (PyErr_Occurred()) {
         goto ctx_switch;
     } else {
-        return Py_None;
+        Py_RETURN_NONE;
     }
 
 ctx_switch:
@@ -759,13 +1526,175 @@ ctx_switch:
     }
 }
 
+// send_many(xs) queues xs where the consumer will find it and hands
+// over control with a single switch, the consumer's await() then
+// drains the queue without switching back.
+static PyObject *
+send_many(PyObject *self, PyObject *args)
+{
+    PyObject *items;
+    PyObject *seq;
+    flowletqueue *q;
+
+    if (!PyArg_UnpackTuple(args, "send_many", 1, 1, &items)) {
+        return NULL;
+    }
+
+    flowletobject *fl = PyFlowlet_GetCurrent();
+
+    if (fl == NULL) {
+        if (!PyErr_Occurred()) {
+            PyErr_SetString(PyExc_RuntimeError, "send_many() only usable within flowlet stack");
+        }
+        return NULL;
+    }
+
+    seq = PySequence_Fast(items, "send_many() argument must be iterable");
+    if (seq == NULL) {
+        return NULL;
+    }
+
+    if (PySequence_Fast_GET_SIZE(seq) == 0) {
+        Py_DECREF(seq);
+        Py_RETURN_NONE;
+    }
+
+    q = (fl->down == NULL) ? &fl->outbox : &fl->down->inbox;
+
+    if (fq_extend(q, seq) < 0) {
+        Py_DECREF(seq);
+        return NULL;
+    }
+    Py_DECREF(seq);
+
+    return send(self, FLOWLET_DRAIN_ARGS, NULL);
+}
+
+// Whether the stream into fl has ended, once await() has returned
+static int
+f_ended(flowletobject *fl)
+{
+    if (fl->up != NULL) {
+        return fl->up->started && fl->up->gr != NULL && !PyGreenlet_ACTIVE(fl->up->gr);
+    }
+    return !fl->initial && fl->source == NULL;
+}
+
+// await_many(n) returns between 1 and n values, blocking for at most
+// one context switch, or an empty list at the end of the stream.
+static PyObject *
+await_many(PyObject *self, PyObject *args)
+{
+    Py_ssize_t n;
+    PyObject *result;
+    PyObject *item;
+
+    if (!PyArg_ParseTuple(args, "n:await_many", &n)) {
+        return NULL;
+    }
+
+    if (n < 1) {
+        PyErr_SetString(PyExc_ValueError, "await_many() needs a positive count");
+        return NULL;
+    }
+
+    item = await(self, NULL);
+    if (item == NULL) {
+        return NULL;
+    }
+
+    flowletobject *fl = PyFlowlet_GetCurrent();
+
+    // The end of the stream comes as None, which could just as well be
+    // a value. Tell them apart by what woke us up: an iterator source
+    // cleared by flowlet_final(), or an upstream which has returned.
+    if (fl != NULL && f_ended(fl)) {
+        Py_DECREF(item);
+        return PyList_New(0);
+    }
+
+    result = PyList_New(0);
+    if (result == NULL || PyList_Append(result, item) < 0) {
+        Py_DECREF(item);
+        Py_XDECREF(result);
+        return NULL;
+    }
+    Py_DECREF(item);
+
+    while (fl != NULL && PyList_GET_SIZE(result) < n && fl->inbox.count > 0) {
+        item = fq_pop(&fl->inbox);
+        if (PyList_Append(result, item) < 0) {
+            Py_DECREF(item);
+            Py_DECREF(result);
+            return NULL;
+        }
+        Py_DECREF(item);
+    }
+
+    // An iterator source can be read ahead just as cheaply, exhaustion
+    // is left for the next await() to notice
+    while (fl != NULL && fl->source != NULL && PyList_GET_SIZE(result) < n) {
+        item = f_pull(fl);
+        if (item == NULL) {
+            if (PyErr_Occurred()) {
+                Py_DECREF(result);
+                return NULL;
+            }
+            break;
+        }
+        if (PyList_Append(result, item) < 0) {
+            Py_DECREF(item);
+            Py_DECREF(result);
+            return NULL;
+        }
+        Py_DECREF(item);
+    }
+
+    return result;
+}
+
+// suspend(to=None), hand control to the greenlet ``to``, by default our
+// parent, until someone calls f.resume(). A hub suspends flowlets into
+// its own greenlet so that the rest of their stack is left untouched.
 static PyObject *
 suspend(PyObject *self, PyObject *args, PyObject *kwargs)
 {
+    static char *kwlist[] = {"to", NULL};
+    PyObject *to = Py_None;
+    PyObject *res;
     flowletobject *fl = (flowletobject *)(PyFlowlet_GetCurrent());
+
+    if (fl == NULL) {
+        if (!PyErr_Occurred()) {
+            PyErr_SetString(PyExc_RuntimeError, "suspend() only usable within flowlet stack");
+        }
+        return NULL;
+    }
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|O:suspend", kwlist, &to)) {
+        return NULL;
+    }
+
+    if (to == Py_None) {
+        to = (PyObject *)fl->gr->parent;
+    } else if (!PyGreenlet_Check(to)) {
+        PyErr_SetString(PyExc_TypeError, "suspend() can only switch to a greenlet");
+        return NULL;
+    }
+
     fl->suspended = 1;
-    PyGreenlet_Switch(fl->gr->parent, NULL, NULL);
-    return Py_None;
+    res = PyGreenlet_Switch((PyGreenlet *)to, NULL, NULL);
+
+    // Unwound by a dying flowlet, which must not be cached again
+    if (res == NULL) {
+        return NULL;
+    }
+    Py_DECREF(res);
+
+    // Whoever resumed us left their own flowlet cached
+    FLOWLET_CURRENT = fl;
+    fl->suspended = 0;
+    Py_RETURN_NONE;
 }
 
 static PyObject *
@@ -774,8 +1703,11 @@ get_flowlet(PyObject *self, PyObject *arg)
     flowletobject *fl = (flowletobject *)PyFlowlet_GetCurrent();
 
     if (fl == NULL) {
-        return Py_None;
+        // Not an error here, we are simply outside of any flowlet
+        PyErr_Clear();
+        Py_RETURN_NONE;
     } else {
+        Py_INCREF(fl);
         return (PyObject *)fl;
     }
 }
@@ -784,6 +1716,22 @@ get_flowlet(PyObject *self, PyObject *arg)
 // Utils
 // =====
 
+PyDoc_STRVAR(pool_stats_doc, "Hit and miss counts of the flowlet freelist and greenlet pool.");
+
+static PyObject *
+pool_stats(PyObject *self)
+{
+    return Py_BuildValue("{s:n,s:n,s:i,s:n,s:n,s:i,s:N}",
+        "flowlet_hits"     , flowlet_hits,
+        "flowlet_misses"   , flowlet_misses,
+        "flowlet_free"     , num_free_flowlets,
+        "greenlet_hits"    , greenlet_hits,
+        "greenlet_misses"  , greenlet_misses,
+        "greenlet_free"    , num_free_greenlets,
+        "greenlet_pooling" , PyBool_FromLong(greenlet_pooling)
+    );
+}
+
 PyDoc_STRVAR(exhaust_doc, "Exhaust an interable, discarding all values.");
 
 static PyObject *
@@ -810,7 +1758,7 @@ pipes_exhaust(PyObject *self, PyObject *args)
     if (PyErr_Occurred()) {
         return NULL;
     }
-    return Py_True;
+    Py_RETURN_TRUE;
 }
 
 PyDoc_STRVAR(id_doc, "The identity function.");
@@ -826,11 +1774,14 @@ Id(PyObject *self, PyObject *arg)
 static PyMethodDef flow_methods[] = {
     {"await"      , await         , METH_NOARGS                  , NULL }        ,
     {"send"       , send          , METH_VARARGS | METH_KEYWORDS , NULL }        ,
+    {"await_many" , await_many    , METH_VARARGS                 , NULL }        ,
+    {"send_many"  , send_many     , METH_VARARGS                 , NULL }        ,
     {"close"      , f_close       , METH_NOARGS                  , NULL }        ,
     {"suspend"    , suspend       , METH_VARARGS | METH_KEYWORDS , NULL }        ,
     {"getcurrent" , get_flowlet   , METH_NOARGS                  , NULL }        ,
     {"exhaust"    , pipes_exhaust , METH_VARARGS                 , exhaust_doc } ,
     {"Id"         , Id            , METH_O                       , id_doc }      ,
+    {"pool_stats" , (PyCFunction)pool_stats , METH_NOARGS        , pool_stats_doc } ,
     {NULL      , NULL}
 };
 
@@ -849,9 +1800,17 @@ initflow(void)
     char *name;
     PyObject *m;
 
+    greenlet_pooling = f_greenlet_layout();
+
     PyExc_FlowletExit = PyErr_NewException("flow.FlowletExit", PyExc_Exception, NULL);
     PyExc_BlockedUpstream = PyErr_NewException("flow.BlockedUpstream", PyExc_Exception, NULL);
 
+    FLOWLET_PARAM = PyTuple_New(0);
+    FLOWLET_DRAIN = PyObject_CallObject((PyObject *)&PyBaseObject_Type, NULL);
+    FLOWLET_DRAIN_ARGS = PyTuple_Pack(1, FLOWLET_DRAIN);
+    FLOWLET_RUNNER = PyCFunction_New(&f_run_def, NULL);
+    FLOWLET_EXHAUSTED = PyTuple_Pack(1, Py_None);
+
     PyTypeObject *typelist[] = {
         &flowlet_type,
         NULL
@@ -1,6 +1,17 @@
 #include <Python.h>
 #include "greenlet.h"
 
+// Growable FIFO of pending values, drained by await() before it
+// falls back to a context switch.
+typedef struct _flowletqueue {
+
+    PyObject **items;
+    Py_ssize_t head;
+    Py_ssize_t count;
+    Py_ssize_t size;
+
+} flowletqueue;
+
 typedef struct _flowlet {
 
     PyObject_HEAD
@@ -23,4 +34,16 @@ typedef struct _flowlet {
     struct _flowlet *up;
     struct _flowlet *down;
 
+    // A plain Python iterable bound in place of an upstream flowlet,
+    // await() pulls from it directly without a context switch. Turned
+    // into an iterator on first use, at which point iter is set.
+    PyObject *source;
+
+    // Values sent to this flowlet but not yet awaited, upstream runs
+    // ahead without switching until bufsize of them are queued
+    flowletqueue inbox;
+    Py_ssize_t bufsize;
+    // Values sent out of a terminal flowlet but not yet awaited
+    flowletqueue outbox;
+
 } flowletobject;
@@ -8,32 +8,74 @@ is_pypy = hasattr(sys, 'pypy_version_info')
 is_cpython = not is_pypy
 
 if is_cpython:
-    from flow import flowlet as _flowlet, send
+    from flow import flowlet as _flowlet, send, await
 elif is_pypy:
     from flow_pypy import flowlet as _flowlet
 else:
     raise ImportError("Your interpreter is not supported!")
 
-def flowlet(f):
+def flowlet(f=None, **options):
+    """
+    Lift a function into a Flowlet constructor, either as a bare
+    ``@flowlet`` or with options as ``@flowlet(buffer=1024)``.
+    """
+    if f is None:
+        return partial(flowlet, **options)
+
     @wraps(f)
     def wrapper(*args, **kwargs):
-        return Flowlet(logic=f, args=args, kwargs=kwargs, name=f.__name__)
+        fl = Flowlet(logic=f, args=args, kwargs=kwargs, name=f.__name__,
+                **options)
+        fl.constructor = wrapper
+        return fl
     return wrapper
 
-# XXX: Write this in C
-def from_iter(it):
-    for i in it:
-        send(i)
+# The element-wise operations a stateless flowlet may declare, which
+# lets a run of them be fused into a single flowlet.
+#
+#   map    : send(f(x))
+#   filter : send(x) if f(x)
+#   sink   : f(x)
+
+STATELESS = ('map', 'filter', 'sink')
+
+def fused(*ops):
+    while 1:
+        x = await()
+        for kind, f in ops:
+            if kind == 'map':
+                x = f(x)
+            elif kind == 'filter':
+                if not f(x):
+                    break
+            else:
+                f(x)
+                break
+        else:
+            send(x)
 
 class Flowlet(Pipe):
 
     lazy = True
 
     def __init__(self, source=None, logic=None, args=None,
-            kwargs=None, name=None, composite=False):
+            kwargs=None, name=None, composite=False, buffer=None,
+            stateless=None):
         self.started = False
         self.finalized = False
         self.composite = composite
+        self.stages = None
+
+        if stateless not in STATELESS + ('fused', None):
+            raise ValueError("Unknown stateless operation %r" % stateless)
+
+        # A stateless flowlet takes the per-element function as its
+        # only argument and acts on each element as declared.
+        self.stateless = stateless
+
+        # Number of values upstream may run ahead by before switching
+        # into this flowlet, unbuffered by default.
+        self.buffer = buffer
 
         self.args = args or ()
         self.kwargs = kwargs or {}
@@ -42,12 +84,45 @@ class Flowlet(Pipe):
         self.logic = logic
         self.line = []
 
-    def __call__(self, ins):
+    @property
+    def fusable(self):
+        if self.stateless == 'fused':
+            return True
+        return bool(self.stateless) and len(self.args) == 1 and not self.kwargs
+
+    def operations(self):
+        if self.stateless == 'fused':
+            return self.args
+        return ((self.stateless, self.args[0]),)
 
+    def fuse(self, other):
+        if not (self.fusable and getattr(other, 'fusable', False)):
+            return None
+
+        return Flowlet(
+            logic=fused, args=self.operations() + other.operations(),
+            name='%s+%s' % (self.name, other.name), stateless='fused',
+            buffer=self.buffer
+        )
+
+    def instance(self):
         fl = _flowlet(self.logic, *self.args, **self.kwargs)
-        if isinstance(ins, _flowlet):
-            fl.bind(ins)
-        else:
-            ins = _flowlet(from_iter, ins)
+        if self.buffer:
+            fl.buffer = self.buffer
+        return fl
+
+    def compile(self):
+        fl = self.instance()
+
+        # The same flowlet is reset and rewired on every run
+        def rewire(ins):
+            fl.reset()
             fl.bind(ins)
+            return fl
+        return rewire
+
+    def __call__(self, ins):
+        fl = self.instance()
+        # Anything that isn't a flowlet is read directly as an iterator
+        fl.bind(ins)
         return fl
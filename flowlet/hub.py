@@ -0,0 +1,338 @@
+import sys
+import time
+import errno
+import heapq
+import select
+import threading
+
+from collections import deque
+from contextlib import contextmanager
+from itertools import count
+from greenlet import greenlet, getcurrent as current_greenlet
+
+from flow import suspend, getcurrent
+
+# Hub
+# ===
+
+# Runs any number of pipelines on one OS thread. Each pipeline runs in a
+# greenlet of its own and a flowlet which would block reading a file
+# descriptor suspends itself into the hub instead, which resumes it from
+# an epoll loop once the descriptor is ready. Only the waiting flowlet is
+# switched out, the stages around it stay where they were in their own
+# greenlets.
+#
+# Descriptors are registered one shot and only rearmed by the next wait
+# on them, readiness nobody waits for any more is dropped.
+#
+# wait_read is what the IO sources call before they read, it returns
+# straight away unless a hub is running on this thread.
+#
+# The hub either runs its own loop with run(), or is driven from another
+# event loop: its epoll descriptor, fileno(), is readable whenever one of
+# the descriptors waited on is and step() does a round of work without
+# blocking. Values come in from that loop's callbacks through a Channel.
+
+local = threading.local()
+
+def wait_read(fd, timeout=None):
+    """
+    Wait until ``fd``, or the object with ``fileno()``, is ready to be
+    read, if running under a hub. False when ``timeout`` ran out first.
+    """
+    hub = getattr(local, 'hub', None)
+    if hub is None:
+        return True
+    return hub.wait(fd, select.EPOLLIN, timeout)
+
+class Task(object):
+
+    def __init__(self, line, runner):
+        self.line = line
+        self.runner = runner
+        self.value = None
+        self.exc_info = None
+        self.done = False
+        self.callbacks = []
+
+    def add_done_callback(self, f):
+        """
+        Call ``f(task)`` once the pipeline is done, straight away if it
+        is already.
+        """
+        if self.done:
+            f(self)
+        else:
+            self.callbacks.append(f)
+
+    def result(self):
+        if not self.done:
+            raise RuntimeError("Task not done")
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+    def __call__(self):
+        try:
+            self.value = self.runner(self.line)
+        except Exception:
+            self.exc_info = sys.exc_info()
+
+        self.done = True
+        for f in self.callbacks:
+            f(self)
+        del self.callbacks[:]
+
+class Hub(object):
+
+    def __init__(self):
+        self.tasks = []
+        # Opened on first use and held until close()
+        self.epoll = None
+        self.greenlet = None
+
+        # fd -> (flowlet, token) for everyone waiting
+        self.waiting = {}
+        self.armed = set()
+        # (deadline, token, fd) for the waits with a timeout
+        self.timers = []
+        self.tokens = count()
+        self.fired = False
+
+        # Flowlets woken up by a channel and those waiting on one
+        self.ready = deque()
+        self.parked = 0
+
+    def poller(self):
+        if self.epoll is None:
+            self.epoll = select.epoll()
+        return self.epoll
+
+    def fileno(self):
+        return self.poller().fileno()
+
+    def spawn(self, line, runner=None):
+        """
+        Run the pipeline ``line`` under the hub, with ``runPipeline``
+        unless given another ``runner``. Returns a Task which holds the
+        result once the pipeline is done.
+        """
+        if runner is None:
+            from pipeline import runPipeline as runner
+        task = Task(line, runner)
+        self.tasks.append(task)
+        return task
+
+    def wait(self, fd, events, timeout=None):
+        fd = fd if isinstance(fd, (int, long)) else fd.fileno()
+        fl = getcurrent()
+
+        if fl is None:
+            raise RuntimeError("wait() only usable within flowlet stack")
+        if fd in self.waiting:
+            raise ValueError("Already waiting on descriptor %i" % fd)
+
+        epoll = self.poller()
+        flags = events | select.EPOLLONESHOT
+        if fd in self.armed:
+            try:
+                epoll.modify(fd, flags)
+            except IOError:
+                # Closed and reused since, the old registration is gone
+                epoll.register(fd, flags)
+        else:
+            epoll.register(fd, flags)
+            self.armed.add(fd)
+
+        token = next(self.tokens)
+        self.waiting[fd] = (fl, token)
+        if timeout is not None:
+            heapq.heappush(self.timers, (time.time() + timeout, token, fd))
+
+        suspend(self.greenlet)
+        return self.fired
+
+    def park(self):
+        # Until someone puts us on the ready queue
+        self.parked += 1
+        try:
+            suspend(self.greenlet)
+        finally:
+            self.parked -= 1
+
+    def wake(self, fd, fired):
+        fl, token = self.waiting.pop(fd)
+        self.fired = fired
+        fl.resume()
+
+    def expire(self):
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            _, token, fd = heapq.heappop(self.timers)
+            waiter = self.waiting.get(fd)
+            if waiter is not None and waiter[1] == token:
+                self.wake(fd, False)
+
+    def next_timeout(self):
+        """
+        Seconds until the next wait times out, -1 if none will.
+        """
+        # Timers of waits which are long over are dropped on the way
+        while self.timers:
+            _, token, fd = self.timers[0]
+            waiter = self.waiting.get(fd)
+            if waiter is not None and waiter[1] == token:
+                return max(0, self.timers[0][0] - time.time())
+            heapq.heappop(self.timers)
+        return -1
+
+    @contextmanager
+    def running(self):
+        hub = getattr(local, 'hub', None)
+        if hub is not None and hub is not self:
+            raise RuntimeError("A hub is already running on this thread")
+
+        self.greenlet = current_greenlet()
+        local.hub = self
+        try:
+            yield
+        finally:
+            local.hub = hub
+
+    def runnable(self):
+        # Anything the hub can get on with by itself
+        return bool(self.tasks or self.waiting or self.ready)
+
+    def pending(self):
+        """
+        Whether any pipeline is not done yet, including those waiting
+        on a channel.
+        """
+        return self.runnable() or self.parked > 0
+
+    def step(self, timeout=0):
+        """
+        Start the pipelines spawned since the last step and resume those
+        which can go on, waiting up to ``timeout`` seconds for one of
+        their descriptors (-1 to wait for as long as it takes). Returns
+        whether there is anything left to do.
+        """
+        with self.running():
+            while self.tasks:
+                task = self.tasks.pop(0)
+                greenlet(task, parent=self.greenlet).switch()
+
+            while self.ready:
+                self.fired = True
+                self.ready.popleft().resume()
+
+            if self.waiting:
+                ahead = self.next_timeout()
+                if self.ready or self.tasks:
+                    ahead = 0
+                elif timeout >= 0 and (ahead < 0 or ahead > timeout):
+                    ahead = timeout
+
+                try:
+                    ready = self.epoll.poll(ahead)
+                except IOError as e:
+                    if e.errno != errno.EINTR:
+                        raise
+                    ready = []
+
+                for fd, _ in ready:
+                    if fd in self.waiting:
+                        self.wake(fd, True)
+                self.expire()
+
+        return self.pending()
+
+    def run(self):
+        """
+        Run all the spawned pipelines until every one of them is done,
+        returns their results in the order they were spawned. The first
+        exception raised by any of them is raised once they all are.
+        """
+        tasks = list(self.tasks)
+
+        while self.runnable():
+            self.step(-1)
+
+        if self.parked:
+            raise RuntimeError("%i flowlets wait on channels nothing will fill"
+                    % self.parked)
+
+        for task in tasks:
+            if task.exc_info:
+                raise task.exc_info[0], task.exc_info[1], task.exc_info[2]
+        return [task.value for task in tasks]
+
+    def close(self):
+        """
+        Release the epoll descriptor, a later wait opens a new one.
+        """
+        if self.epoll is not None:
+            self.epoll.close()
+            self.epoll = None
+        self.armed.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# Channels
+# ========
+
+# A channel carries values from outside a hub's pipelines into them, put
+# from an event loop callback or from another pipeline under the hub. A
+# flowlet finding it empty parks in the hub until a value or the end is
+# put on it. Any number of flowlets may wait on one channel, a value
+# wakes the longest waiting and the end wakes them all. Not thread safe,
+# it lives on the hub's thread.
+
+class Channel(object):
+
+    def __init__(self):
+        self.items = deque()
+        self.closed = False
+        self.waiters = deque()
+
+    def put(self, x):
+        if self.closed:
+            raise ValueError("Channel closed")
+        self.items.append(x)
+        self.notify()
+
+    def close(self):
+        self.closed = True
+        self.notify(everyone=True)
+
+    def notify(self, everyone=False):
+        while self.waiters:
+            hub, fl = self.waiters.popleft()
+            hub.ready.append(fl)
+            if not everyone:
+                break
+
+    def wait(self):
+        """
+        Wait until the channel has values or is closed.
+        """
+        while not self.items and not self.closed:
+            hub = getattr(local, 'hub', None)
+            if hub is None:
+                raise RuntimeError("Waiting on an empty channel outside a hub")
+            fl = getcurrent()
+            if fl is None:
+                raise RuntimeError("wait() only usable within flowlet stack")
+
+            waiter = (hub, fl)
+            self.waiters.append(waiter)
+            try:
+                hub.park()
+            finally:
+                # Still there when unwound instead of woken up
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
@@ -1,7 +1,9 @@
 import sys
+import copy_reg
+import weakref
 from greenlet import greenlet, GreenletExit
 from types import XRangeType, GeneratorType, DictionaryType
-from functools import wraps
+from functools import wraps, partial
 from itertools import islice, count, cycle, chain
 from collections import Iterable, deque
 
@@ -18,14 +20,23 @@ isgenerator = lambda obj: isinstance(obj, GeneratorType)
 isgreenlet  = lambda obj: isinstance(obj, greenlet)
 iscoroutine = lambda obj: isgreenlet(obj) or (isgenerator(obj) and hasattr(obj, 'send'))
 
+def isnamed(obj):
+    """
+    Whether ``obj`` is what its module holds under its name, and so can
+    be pickled by reference.
+    """
+    module = sys.modules.get(getattr(obj, '__module__', None))
+    name = getattr(obj, '__name__', None)
+    return module is not None and getattr(module, name, None) is obj
+
 coercions = {
     # Internals
     XRangeType     : lambda obj: LazyPipe(source=obj),
     DictionaryType : lambda obj: StrictPipe(source=obj.iteritems()),
     GeneratorType  : lambda obj: LazyPipe(source=obj),
-    set            : lambda obj: StrictPipe(source=iter(obj)),
-    tuple          : lambda obj: StrictPipe(source=iter(obj)),
-    list           : lambda obj: StrictPipe(source=iter(obj)),
+    set            : lambda obj: StrictPipe(source=obj),
+    tuple          : lambda obj: StrictPipe(source=obj),
+    list           : lambda obj: StrictPipe(source=obj),
 
     # Itertools
     count          : lambda obj: LazyPipe(source=iter(obj)),
@@ -69,13 +80,17 @@ class CannotCoerce(Exception):
 def lazy(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
-        return LazyPipe(logic=f, args=args, kwargs=kwargs, name=f.__name__)
+        p = LazyPipe(logic=f, args=args, kwargs=kwargs, name=f.__name__)
+        p.constructor = wrapper
+        return p
     return wrapper
 
 def strict(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
-        return StrictPipe(logic=f, args=args, kwargs=kwargs, name=f.__name__)
+        p = StrictPipe(logic=f, args=args, kwargs=kwargs, name=f.__name__)
+        p.constructor = wrapper
+        return p
     return wrapper
 
 # Base Pipe
@@ -84,16 +99,20 @@ def strict(f):
 class Pipe(object):
 
     def __init__(self, source=None, logic=None, args=None,
-            kwargs=None, name=None, composite=False):
+            kwargs=None, name=None, composite=False, parts=None):
 
         self.started = False
         self.finalized = False
 
         # When you compose two pipes, the internal logic of the pipes
-        # become fused and the original pipes disappear. You cannot
-        # recover the original pipes from the composite.
+        # become fused and the original pipes disappear. The composite
+        # only links the two pipes it was made of, the flat tuple of
+        # stages ``execute`` wires together is worked out once, the
+        # first time it is asked for, so composing stays constant time.
 
         self.composite = composite
+        self.parts = parts
+        self.stages = None
 
         # Reference to the upstream pipe, set at bind-time
         self.up = None
@@ -101,37 +120,70 @@ class Pipe(object):
 
         self.args = args or ()
         self.kwargs = kwargs or {}
-        self.name = name or self.__class__.__name__
+        self.name = name or (None if composite else self.__class__.__name__)
 
         self.line = []
 
-        if source:
+        if source is not None:
             self.logic = lambda _: iter(source)
         else:
             self.logic = logic
 
     @staticmethod
     def bind(A, B):
-        if A.composite and B.composite:
-            f = A.logic
-            g = B.logic
-            co = lambda x,y: g(x, f(Id, y))
-
-        elif A.composite:
-            f = A.logic
-            co = lambda x,y: x(f(B, y))
-
-        elif B.composite:
-            f = B.logic
-            co = lambda x,y: f(x, A(y))
+        # All four orders of composition (see the README) amount to
+        # running the stages of A and then the stages of B.
+        return Pipe(composite=True, parts=(A, B))
+
+    @property
+    def stages(self):
+        if self.composite and self._stages is None:
+            self._stages = flat_stages(self.parts)
+        return self._stages
+
+    @stages.setter
+    def stages(self, value):
+        self._stages = value
+
+    @property
+    def name(self):
+        if self._name is None and self.composite:
+            self._name = '(%s)' % '.'.join(s.name for s in self.stages)
+        return self._name
+
+    @name.setter
+    def name(self, value):
+        self._name = value
 
+    def __call__(self, ins):
+        if self.composite:
+            return execute(self.stages, Id, ins)
         else:
-            co = lambda x,y: x(B(A(y)))
-
-        return Pipe(
-            logic=co, name='(%s.%s)' % (A.name, B.name),
-            composite=True
-        )
+            return self.logic(ins, *self.args, **self.kwargs)
+
+    def fuse(self, other):
+        """
+        Combine this stage with the ``other`` stage directly downstream
+        of it into a single stage, or None if they cannot be fused.
+        """
+        return None
+
+    def compile(self):
+        """
+        A callable to run this stage with in a compiled pipeline, which
+        may hold on to whatever it can reuse from one run to the next.
+        """
+        return self
+
+    def __reduce_ex__(self, protocol):
+        # A pipe made by a decorated constructor is pickled as a call to
+        # the constructor, the function it wraps can't be found by name.
+        constructor = getattr(self, 'constructor', None)
+        if not isnamed(constructor):
+            state = dict(self.__dict__)
+            state.pop('constructor', None)
+            return (copy_reg.__newobj__, (type(self),), state)
+        return (partial(constructor, *self.args, **self.kwargs), ())
 
     # XXX: deprecated??
     def __or__(self, dstruct):
@@ -139,7 +191,7 @@ class Pipe(object):
         assert callable(dstruct)
 
         if self.composite:
-            return self.logic(dstruct, [])
+            return execute(self.stages, dstruct, [])
         else:
             return dstruct(self.logic([]))
 
@@ -213,12 +265,110 @@ def extract(ins):
         ins.close()
     return result
 
-def runPipeline(line, dstruct=list):
-    if hasattr(line, 'composite') and line.composite:
-        result = line.logic(dstruct, Nothing())
+# Executor
+# ========
+
+def stages(line):
+    """
+    The individual stages of a pipeline in order of flow.
+    """
+    if getattr(line, 'composite', False):
+        return line.stages
     else:
-        result = dstruct(line.logic(Nothing()))
-    return result
+        return (line,)
+
+def flat_stages(parts):
+    """
+    The stages of the pipes ``parts`` in order of flow, walked without
+    recursion so that deeply nested composites can be flattened.
+    """
+    flat = []
+    todo = list(reversed(parts))
+    while todo:
+        part = todo.pop()
+        if not getattr(part, 'composite', False):
+            flat.append(part)
+        elif part._stages is not None:
+            flat.extend(part._stages)
+        else:
+            todo.extend(reversed(part.parts))
+    return tuple(flat)
+
+def execute(line, dstruct, ins):
+    """
+    Wire a tuple of stages together, feeding ``ins`` into the first and
+    handing the output of the last to ``dstruct``.
+    """
+    for stage in line:
+        ins = stage(ins)
+    return dstruct(ins)
+
+# Optimizer
+# =========
+
+def fuse_stages(line):
+    fused = []
+    for stage in line:
+        joined = fused and fused[-1].fuse(stage)
+        if joined:
+            fused[-1] = joined
+        else:
+            fused.append(stage)
+    return tuple(fused)
+
+def plan(line, fuse=True):
+    """
+    The stages a pipeline will be run as, after fusion.
+    """
+    if fuse:
+        return fuse_stages(stages(line))
+    else:
+        return stages(line)
+
+def runPipeline(line, dstruct=list, fuse=True):
+    return execute(plan(line, fuse), dstruct, Nothing())
+
+def iterPipeline(line, fuse=True):
+    return runPipeline(line, Id, fuse)
+
+# Compiler
+# ========
+
+class CompiledPipeline(object):
+    """
+    A pipeline wired up once and then run any number of times over
+    different sources. Only one run may be in flight at a time, starting
+    a run resets the stages of the previous one, which has to have been
+    exhausted, closed or dropped.
+    """
 
-def iterPipeline(line):
-    return runPipeline(line, Id)
+    def __init__(self, line, fuse=True):
+        self.line = line
+        self.stages = tuple(stage.compile() for stage in plan(line, fuse))
+        # The iterator of the last run started with iter()
+        self.current = None
+
+    def check(self):
+        current = self.current and self.current()
+        if current is not None and current.gi_frame is not None:
+            raise RuntimeError("A run of this compiled pipeline is still "
+                    "in flight, exhaust, close or drop it first")
+
+    def run(self, source=None, dstruct=list):
+        self.check()
+        if source is None:
+            source = Nothing()
+        return execute(self.stages, dstruct, source)
+
+    def iter(self, source=None):
+        run = results(self.run(source, Id))
+        self.current = weakref.ref(run)
+        return run
+
+def results(it):
+    # Tracked by a compiled pipeline, see CompiledPipeline.check
+    for x in it:
+        yield x
+
+def compilePipeline(line, fuse=True):
+    return CompiledPipeline(line, fuse)
@@ -1,26 +1,42 @@
 from __future__ import print_function
 
+import sys
+import time
 from functools import partial
-from itertools import islice, count, chain
+from collections import deque
+from itertools import islice, count, chain, cycle
 
-from Queue import Empty
+import os
+import mmap
+import struct
+import traceback
+
+from Queue import Empty, Queue as ThreadQueue
+from cStringIO import StringIO
+from cPickle import dumps, loads, HIGHEST_PROTOCOL
 from contextlib import closing
 from flow import await, send, close, BlockedUpstream, flowlet as _flowlet
-from flow import Id, exhaust
-from multiprocessing import Process, Queue
+from flow import send_many, await_many
+from flow import Id, exhaust, getcurrent
+from multiprocessing import Process, Queue, BufferTooShort
 from select import select
+from threading import Thread
 
 from flowlet import flowlet, Flowlet
+from hub import Hub, Channel, wait_read
+from shm import ShmQueue, ring_bell, sharing, release, have_numpy, SHARE_THRESHOLD
 from pipeline import lazy, strict, runPipeline
 
 try:
     import cython
+    from cythoncache import compiled
     have_cython = True
 except:
     have_cython = False
 
 try:
     import numexpr
+    import numpy
     have_numexpr = True
 except:
     have_numexpr = False
@@ -32,14 +48,14 @@ idLazy   = lazy(Id)
 # ----
 
 # pipe :: (a -> b) -> a ~> b
-@flowlet
+@flowlet(stateless='map')
 def pipe(f):
     while 1:
         x = await()
         send(f(x))
 
 # pipe_ :: (a -> b) -> a ~> ()
-@flowlet
+@flowlet(stateless='sink')
 def pipe_(f):
     while 1:
         x = await()
@@ -100,28 +116,196 @@ def flatten(iterator):
 # Resources
 # ---------
 
+# filepipe reads in blocks of chunk_size bytes and either sends the raw
+# blocks or the lines split out of them, all the lines of a block are
+# handed downstream with a single switch. Ends at end of file.
+
 @flowlet
-def filepipe(fname):
-    with open(fname) as f:
-        while 1:
-            send(f.readline())
+def filepipe(fname, mode='lines', chunk_size=1 << 20):
+    if mode not in ('lines', 'chunks'):
+        raise ValueError("Unknown filepipe mode %r" % mode)
+
+    with open(fname, 'rb') as f:
+        blocks = iter(partial(f.read, chunk_size), '')
+
+        if mode == 'chunks':
+            for block in blocks:
+                send(block)
+            return
+
+        # The pieces of a line that runs across blocks are only joined
+        # once its newline arrives, so a long line is copied just once.
+        tail = []
+        for block in blocks:
+            if '\n' not in block:
+                tail.append(block)
+                continue
+            lines = StringIO(block).readlines()
+            if tail:
+                tail.append(lines[0])
+                lines[0] = ''.join(tail)
+            tail = [] if lines[-1].endswith('\n') else [lines.pop()]
+            send_many(lines)
+
+        if tail:
+            send(''.join(tail))
+
+# mmappipe maps the file into memory and sends read-only buffer slices
+# of it, split on the delimiter (which is dropped) or every width bytes.
+# The slices keep the mapping alive and nothing is copied until they
+# are read.
+
+def mmap_records(m, delimiter, width):
+    size = len(m)
+
+    if width:
+        for start in xrange(0, size, width):
+            yield buffer(m, start, width)
+        return
+
+    start, step = 0, len(delimiter)
+    while start < size:
+        end = m.find(delimiter, start)
+        if end < 0:
+            end = size
+        yield buffer(m, start, end - start)
+        start = end + step
+
+@flowlet
+def mmappipe(fname, delimiter='\n', width=None, batch=4096):
+    if width is not None and width < 1:
+        raise ValueError("mmappipe width must be at least 1, got %r" % width)
+    if width is None and not delimiter:
+        raise ValueError("mmappipe needs a non-empty delimiter or a width")
+
+    with open(fname, 'rb') as f:
+        # An empty file cannot be mapped
+        if not os.fstat(f.fileno()).st_size:
+            return
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    records = mmap_records(m, delimiter, width)
+    while 1:
+        records_batch = list(islice(records, batch))
+        if not records_batch:
+            return
+        send_many(records_batch)
+
+# With a batch queuepipe waits for one value and then takes whatever else
+# is already on the queue, up to batch values in all, and sends them on
+# together, one by one with send_many or as a list with emit='chunks'.
+# queueput with a batch puts the values ready upstream, up to batch of
+# them, on the queue as one Batch.
 
 @flowlet
-def queuepipe(queue, block=True):
+def queuepipe(queue, block=True, idle=None, batch=None, emit='items'):
+    if emit not in ('items', 'chunks'):
+        raise ValueError("Unknown emit %r" % emit)
+
     while 1:
         try:
-            item = queue.get(block=block)
-            send(item)
+            item = poll(queue, block, idle)
+            if not batch:
+                unbatch(item)
+                continue
         except (Empty, EOFError):
             close()
             break
 
+        items = drain(queue, extend([], item), batch)
+        if emit == 'chunks':
+            send(items)
+        else:
+            send_many(items)
+
+def extend(items, item):
+    if type(item) is Batch:
+        items.extend(item)
+    else:
+        items.append(item)
+    return items
+
+def drain(queue, items, n):
+    # What else is on the queue without waiting, up to n values in all,
+    # the queue closing is noticed by the next poll
+    while len(items) < n:
+        try:
+            extend(items, queue.get(block=False))
+        except (Empty, EOFError):
+            break
+    return items
+
+# Values can be shipped over a queue a Batch at a time, queuepipe and
+# jobpipe send a Batch on as the values it holds. A Batcher stands in for
+# the queue to batch up the results of a worker, it is flushed when full,
+# when it has lingered for linger_ms, and whenever the queue feeding the
+# worker runs dry.
+
+class Batch(list):
+    pass
+
+class Batcher(object):
+
+    def __init__(self, queue, size, linger_ms=None):
+        self.queue = queue
+        self.size = size
+        self.linger = linger_ms / 1000.0 if linger_ms is not None else None
+        self.pending = Batch()
+        self.since = None
+
+    def expired(self):
+        if len(self.pending) >= self.size:
+            return True
+        return (self.linger is not None and bool(self.pending)
+                and time.time() - self.since >= self.linger)
+
+    def put(self, x):
+        if not self.pending:
+            self.since = time.time()
+        self.pending.append(x)
+
+        if self.expired():
+            return self.flush()
+        return 0
+
+    def flush(self):
+        n = len(self.pending)
+        if n:
+            self.queue.put(self.pending)
+            self.pending = Batch()
+        return n
+
+def poll(queue, block, idle):
+    # Calls idle before blocking on an empty queue
+    if idle is not None:
+        try:
+            return queue.get(block=False)
+        except Empty:
+            idle()
+    # Under a hub a process queue waits for its pipe without blocking
+    reader = getattr(queue, '_reader', None)
+    if block and reader is not None:
+        wait_read(reader)
+    return queue.get(block=block)
+
+def unbatch(item):
+    if type(item) is Batch:
+        send_many(item)
+    else:
+        send(item)
+
 @flowlet
-def queueput(queue):
+def queueput(queue, batch=None):
     while 1:
         try:
-            x = await()
-            queue.put(x)
+            if batch:
+                items = await_many(batch)
+                if not items:
+                    break
+                queue.put(Batch(items))
+            else:
+                x = await()
+                queue.put(x)
         except BlockedUpstream:
             close()
             break
@@ -131,22 +315,163 @@ def ipcpipe(pipe):
     with closing(pipe):
         while 1:
             try:
+                wait_read(pipe)
                 item = pipe.recv()
                 send(item)
             except EOFError:
                 close()
                 break
 
+# A stream socket signals its end with an empty read, not EOFError.
+
 @flowlet
-def sockpipe(sock):
+def sockpipe(sock, bufsize=1 << 16):
     with closing(sock):
+        while 1:
+            wait_read(sock)
+            item = sock.recv(bufsize)
+            if not item:
+                close()
+                break
+            send(item)
+
+# Framed Sources
+# --------------
+
+# Messages over a stream socket are framed with a 4 byte big endian
+# length. sockframes reads with recv_into into a small pool of buffers
+# allocated up front and sends memoryviews of the frames, all those
+# completed by a read at once. The pool moves on to the next buffer after
+# every read which completes a frame, carrying over the start of the next
+# frame, so a frame stays valid for buffers - 1 more reads and has to be
+# copied out with tobytes() if it is kept any longer. A frame which does
+# not fit gets a larger buffer in its place.
+#
+# ipcframes does the same over a multiprocessing Connection, which is
+# framed already, with recv_bytes_into, one message per buffer.
+
+FRAME = struct.Struct('!I')
+
+def frame(data):
+    # str() of a bytearray or buffer is its bytes, not so for memoryview
+    data = data.tobytes() if type(data) is memoryview else str(data)
+    return FRAME.pack(len(data)) + data
+
+def read_frames(recv_into, buffers, size):
+    if buffers < 2 or size < FRAME.size:
+        raise ValueError("Needs at least 2 buffers of %i bytes" % FRAME.size)
+
+    pool = [bytearray(size) for _ in xrange(buffers)]
+    i, start, end = 0, 0, 0
+
+    while 1:
+        buf = pool[i]
+        n = recv_into(memoryview(buf)[end:])
+        if not n:
+            if end > start:
+                raise EOFError("Stream ended in the middle of a frame")
+            return
+        end += n
+
+        view, frames = memoryview(buf), []
+        while end - start >= FRAME.size:
+            length, = FRAME.unpack_from(buf, start)
+            if end - start - FRAME.size < length:
+                break
+            start += FRAME.size
+            frames.append(view[start:start+length])
+            start += length
+
+        if frames:
+            yield frames
+        elif end < len(buf):
+            continue
+
+        # On to the next buffer, with the partial frame left over
+        i = (i + 1) % buffers
+        pending, need = end - start, size
+        if pending >= FRAME.size:
+            need = max(need, FRAME.size + FRAME.unpack_from(buf, start)[0])
+        if len(pool[i]) < need:
+            pool[i] = bytearray(need)
+
+        memoryview(pool[i])[:pending] = view[start:end]
+        start, end = 0, pending
+
+@flowlet
+def sockframes(sock, buffers=4, size=1 << 16):
+    def recv_into(buf):
+        wait_read(sock)
+        return sock.recv_into(buf)
+
+    with closing(sock):
+        for frames in read_frames(recv_into, buffers, size):
+            send_many(frames)
+        close()
+
+@flowlet
+def ipcframes(pipe, buffers=4, size=1 << 16):
+    pool = [bytearray(size) for _ in xrange(buffers)]
+    i = 0
+
+    with closing(pipe):
         while 1:
             try:
-                item = sock.recv()
-                send(item)
+                wait_read(pipe)
+                n = pipe.recv_bytes_into(pool[i])
+            except BufferTooShort as e:
+                pool[i] = bytearray(e.args[0])
+                n = len(pool[i])
             except EOFError:
                 close()
                 break
+            send(memoryview(pool[i])[:n])
+            i = (i + 1) % buffers
+
+# frameput :: Socket -> (a ~> ())
+@flowlet
+def frameput(sock, batch=64):
+    while 1:
+        try:
+            items = await_many(batch)
+            if not items:
+                break
+            sock.sendall(''.join(map(frame, items)))
+        except BlockedUpstream:
+            close()
+            break
+
+# Values put on a channel from outside the pipeline, by an event loop
+# driving the hub or another pipeline under it. chanpipe ends once the
+# channel is closed and drained, chanput closes its channel when its
+# upstream is done.
+
+# chanpipe :: Channel -> (a ~> b)
+@flowlet
+def chanpipe(channel):
+    while 1:
+        channel.wait()
+        if not channel.items:
+            close()
+            break
+        items = list(channel.items)
+        channel.items.clear()
+        send_many(items)
+
+# chanput :: Channel -> (a ~> ())
+@flowlet
+def chanput(channel, batch=64):
+    try:
+        while 1:
+            items = await_many(batch)
+            if not items:
+                break
+            for x in items:
+                channel.put(x)
+    except BlockedUpstream:
+        close()
+    finally:
+        channel.close()
 
 # barrier :: (a -> Bool) ~> (a ~> b)
 @flowlet
@@ -161,11 +486,12 @@ def barrier(f):
             send(x)
 
 # filter :: (a -> Bool) ~> (a ~> b)
-@flowlet
+@flowlet(stateless='filter')
 def filter(f):
-    x = await()
-    if f(x):
-        send(x)
+    while 1:
+        x = await()
+        if f(x):
+            send(x)
 
 # first :: (() ~> a) -> (x ~> (a, x))
 def first(f, *args, **kwargs):
@@ -211,29 +537,327 @@ def parmap(f,g):
         x,y = await()
         send((f(x), g(y)))
 
-# ``scatter`` will take a container, split it into equal parts
-# *atemporally* and distribute to workers. Forces the entire stream into
-# memory at the call site.
+# ``scatter`` will take a stream, cut it into chunks of up to ``chunk``
+# elements and distribute them to N workers in turn. A chunk is what is
+# ready upstream, full chunks from an iterator but possibly shorter ones
+# after another flowlet. Only the chunk being cut is held in memory.
 
 # ``roundrobin`` will take a container, split it into equal parts
 # *across time* and distribute to workers. Does not force the stream.
 
-@strict
-def scatter(it, N=1):
-    # Write this in terms of repeated calls to islice(it, n)
-    m = list(it)
-    for i in xrange(0, len(m), N):
-        idx = i % N
-        yield (((idx, m[i:i+N])))
+@flowlet
+def scatter(N=1, chunk=1):
+    for idx in cycle(xrange(N)):
+        part = await_many(chunk)
+        if not part:
+            close()
+            break
+        send((idx, part))
 
 @lazy
 def roundrobin(it, n):
     for i, e in enumerate(it):
         yield (i, e)
 
-def pctx(qi, l, qo):
-    pline = queuepipe(qi) >> l >> queueput(qo)
-    return partial(runPipeline, pline)
+def discard(queue):
+    while 1:
+        try:
+            queue.get(block=False)
+        except (Empty, EOFError):
+            break
+
+def pctx(qi, l, qo, batch=None, linger_ms=None):
+    if not batch:
+        pline = queuepipe(qi) >> l >> queueput(qo)
+        return partial(runPipeline, pline)
+
+    out = Batcher(qo, batch, linger_ms)
+    pline = queuepipe(qi, idle=out.flush) >> l >> queueput(out)
+
+    def run():
+        runPipeline(pline)
+        out.flush()
+    return run
+
+# The transports values can be shipped to and from the workers of par
+# with, each is a queue constructor taking no arguments.
+#
+#   queue : multiprocessing.Queue
+#   shm   : a shared memory ring buffer, see shm.py
+#
+# A ring holds ring_size bytes, every value or batch shipped at once has
+# to fit in it.
+
+transports = {
+    'queue' : Queue,
+    'shm'   : ShmQueue,
+}
+
+def transport_queue(transport, ring_size=None):
+    mkqueue = transports[transport]
+    if transport == 'shm' and ring_size:
+        return partial(mkqueue, size=ring_size)
+    return mkqueue
+
+# The policies par can route values to its workers by, in place of the
+# worker index given with each value. Each is a constructor taking the
+# Outputs of the par and giving a route(idx) function.
+#
+#   roundrobin   : every worker in turn
+#   least_loaded : the worker expected to be done first with the values
+#                  outstanding on it and one more, going by how long
+#                  gather has had to wait per value for its results
+#   steal        : all the workers share one queue in and one queue out,
+#                  idle workers take the next value from it themselves
+
+def roundrobin_dispatch(qo):
+    turn = cycle(xrange(len(qo)))
+    return lambda idx: next(turn)
+
+def least_loaded_dispatch(qo):
+    turn = cycle(xrange(len(qo)))
+
+    def load(idx):
+        return qo.latency[idx] * (qo.outstanding[idx] + 1)
+
+    def route(idx):
+        # Ties go to every worker in turn, workers yet to return a result
+        # have no latency and are tried first
+        start = next(turn)
+        order = range(start, len(qo)) + range(start)
+        return min(order, key=load)
+    return route
+
+def steal_dispatch(qo):
+    return lambda idx: 0
+
+# Weight of the latest message in the running average of the time
+# gather waits per value on a worker
+LATENCY_WEIGHT = 0.25
+
+# The output queues of the workers of a par, as handed to gather, along
+# with the number of values shipped to each worker whose results gather
+# has yet to hand on, and the seconds gather has had to wait per value
+# on the results of each worker. Both carry over from one round of par
+# and gather to the next. Counted in values whether they are shipped one
+# by one or in batches, and including the value a worker is working on.
+
+class Outputs(list):
+
+    def __init__(self, queues, workers=()):
+        list.__init__(self, queues)
+        self.outstanding = [0] * len(queues)
+        self.latency = [0.0] * len(queues)
+        # The processes or threads filling the queues, once started
+        self.workers = workers
+
+    def ship(self, idx, n=1):
+        self.outstanding[idx] += n
+
+    def waited(self, idx, seconds, n):
+        # A message of n results read after waiting on it for seconds
+        self.latency[idx] += LATENCY_WEIGHT * (
+                seconds / n - self.latency[idx])
+
+    def alive(self):
+        # One worker gone breaks the whole par, whichever is waited on
+        return all(w.is_alive() for w in self.workers)
+
+dispatchers = {
+    'roundrobin'   : roundrobin_dispatch,
+    'least_loaded' : least_loaded_dispatch,
+    'steal'        : steal_dispatch,
+}
+
+# A WorkerPool keeps N worker processes around to run one job of par
+# after another. Each worker owns a queue in and a queue out, and is sent
+# the pickled pipeline segment it is to run for a job over a separate
+# control queue. EndOfJob is sent after the last input of the job, and
+# sent back once the worker is done with it. A job which raises sends
+# back JobFailed with the traceback right away, reads the rest of its
+# input up to the EndOfJob and then sends back EndOfJob as usual, so
+# nothing of it is left over for the next job.
+
+class EndOfJob(object):
+    pass
+
+class WorkerDied(RuntimeError):
+    pass
+
+# Waits on the workers of par wake up this often to check they are still
+# alive, in seconds
+LIVENESS_INTERVAL = 0.5
+
+def get_live(queue, alive):
+    # The next item on a queue filled by workers for which alive() holds,
+    # what they put before they died is read first
+    while 1:
+        dead = not alive()
+        try:
+            if dead:
+                return queue.get(block=False)
+            return queue.get(timeout=LIVENESS_INTERVAL)
+        except Empty:
+            if dead:
+                raise WorkerDied("A par worker died")
+
+class JobFailed(object):
+
+    def __init__(self, traceback):
+        self.traceback = traceback
+
+@flowlet
+def jobpipe(queue, idle=None, ended=None):
+    while 1:
+        item = poll(queue, True, idle)
+        if item is EndOfJob:
+            if ended is not None:
+                ended.append(item)
+            break
+        unbatch(item)
+
+def run_job(qi, line, qo, batch=None, linger_ms=None, ended=None):
+    out = Batcher(qo, batch, linger_ms) if batch else None
+
+    try:
+        if out is None:
+            runPipeline(jobpipe(qi, None, ended) >> line >> queueput(qo))
+        else:
+            runPipeline(jobpipe(qi, out.flush, ended) >> line >> queueput(out))
+    finally:
+        if out is not None:
+            out.flush()
+
+def pool_worker(jobs, qi, qo):
+    while 1:
+        job = jobs.get()
+        if job is None:
+            break
+
+        line, batch, linger_ms = job
+        ended = []
+        try:
+            run_job(qi, loads(line), qo, batch, linger_ms, ended)
+        except Exception:
+            qo.put(JobFailed(traceback.format_exc()))
+            while not ended:
+                if qi.get() is EndOfJob:
+                    ended.append(EndOfJob)
+        qo.put(EndOfJob)
+
+class WorkerPool(object):
+    """
+    Long lived worker processes for ``par(..., pool=pool)`` to run its
+    pipelines in, which must be picklable. Runs one par at a time.
+    """
+
+    def __init__(self, N, transport='queue', share_arrays=SHARE_THRESHOLD,
+            ring_size=None):
+        if transport not in transports:
+            raise ValueError("Unknown transport %r" % transport)
+        self.mkqueue = transport_queue(transport, ring_size)
+        self.share_arrays = share_arrays if have_numpy else None
+        self.bell = None
+
+        self.jobs = [None] * N
+        self.qi = [None] * N
+        self.qo = [None] * N
+        self.workers = [None] * N
+        for i in xrange(N):
+            self.spawn(i)
+
+        # The job running and the number of workers it runs on
+        self.job = None
+        self.running = 0
+
+    def spawn(self, i):
+        jobs, qi, qo = Queue(), self.mkqueue(), self.mkqueue()
+        self.bell = ring_bell([qo], self.bell)
+
+        if self.share_arrays:
+            qi, qo = sharing([qi, qo], self.share_arrays)
+
+        p = Process(target=pool_worker, args=(jobs, qi, qo))
+        p.daemon = True
+        p.start()
+
+        self.jobs[i], self.qi[i], self.qo[i], self.workers[i] = jobs, qi, qo, p
+
+    def respawn(self, i):
+        # Whatever the dead worker left on its queues is dropped, along
+        # with the shared arrays in it
+        p = self.workers[i]
+        p.join()
+        for q in (self.qi[i], self.qo[i], self.jobs[i]):
+            discard(q)
+            if hasattr(q, 'cancel_join_thread'):
+                q.cancel_join_thread()
+        if have_numpy:
+            release(p.pid)
+        self.spawn(i)
+
+    def __len__(self):
+        return len(self.workers)
+
+    def start(self, lines, batch=None, linger_ms=None):
+        if len(lines) > len(self):
+            raise ValueError("%i pipelines given to a pool of %i workers"
+                    % (len(lines), len(self)))
+
+        # Pickled here so unpicklable pipelines fail in the caller
+        lines = [dumps(line, HIGHEST_PROTOCOL) for line in lines]
+
+        # A par left unfinished, i.e. one kept alive by the traceback of
+        # an error downstream, is finished before the next job starts
+        self.finish(self.job)
+
+        for i, line in enumerate(lines):
+            if not self.workers[i].is_alive():
+                self.respawn(i)
+            self.jobs[i].put((line, batch, linger_ms))
+
+        self.job = object()
+        self.running = len(lines)
+        return self.job
+
+    def finish(self, job):
+        # Already finished, by a later start or an earlier finish
+        if job is None or job is not self.job:
+            return
+        self.job = None
+
+        # Every worker sends back exactly one EndOfJob, failed or not,
+        # unless it has died, and is then replaced
+        for i in xrange(self.running):
+            p = self.workers[i]
+            if not p.is_alive():
+                self.respawn(i)
+                continue
+
+            self.qi[i].put(EndOfJob)
+            try:
+                # Discard whatever output was never gathered
+                while get_live(self.qo[i], p.is_alive) is not EndOfJob:
+                    pass
+            except WorkerDied:
+                self.respawn(i)
+
+    def close(self):
+        self.finish(self.job)
+        for jobs in self.jobs:
+            jobs.put(None)
+        for p in self.workers:
+            p.join()
+
+    def terminate(self):
+        for p in self.workers:
+            p.terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 @flowlet
 def par(*lines, **kw):
@@ -241,37 +865,163 @@ def par(*lines, **kw):
     N  = kw.get('N') or len(lines)
     if NS: lines = lines*N
 
-    qi = [Queue() for _ in xrange(N)]
-    qo = [Queue() for _ in xrange(N)]
+    pool = kw.get('pool')
     ps = []
+    ts = []
 
-    # suspend
-    send(qo)
-    # resume
+    # The values ready upstream, up to batch of them, are shipped as one
+    # message per worker. Nothing is held back waiting for more, as par
+    # may never be resumed once upstream is done, instead upstream runs
+    # ahead by up to batch values into the buffer of par. The workers
+    # hold their results back until batch are ready, linger_ms has
+    # passed or they run out of input.
+    batch = kw.get('batch')
+    linger_ms = kw.get('linger_ms')
+    if batch:
+        getcurrent().buffer = batch
 
-    for i in xrange(N):
-        parline = pctx(qi[i], lines[i], qo[i])
-        p = Process(target=parline)
-        p.start()
-        ps.append(p)
+    dispatch = kw.get('dispatch')
+    if dispatch is not None and dispatch not in dispatchers:
+        raise ValueError("Unknown dispatch %r" % dispatch)
 
-    while 1:
+    transport = kw.get('transport', 'queue')
+    if transport not in transports:
+        raise ValueError("Unknown transport %r" % transport)
+
+    # Threads are handed their values over the queues of the Queue module
+    # and are stopped with EndOfJob, as they can't be killed
+    executor = kw.get('executor', 'process')
+    if executor not in ('process', 'thread'):
+        raise ValueError("Unknown executor %r" % executor)
+    threaded = executor == 'thread'
+
+    if threaded and pool is not None:
+        raise ValueError("A WorkerPool runs processes")
+
+    if dispatch == 'steal' and (pool is not None or transport != 'queue'):
+        raise ValueError("dispatch='steal' needs queues shared by workers "
+                "of its own")
+
+    if pool is not None:
+        job = pool.start(lines, batch, linger_ms)
+        qi, qo = pool.qi[:N], pool.qo[:N]
+        workers = pool.workers[:N]
+    elif dispatch == 'steal':
+        mkqueue = ThreadQueue if threaded else Queue
+        qi = [mkqueue()] * N
+        qo = [mkqueue()] * N
+    else:
+        mkqueue = ThreadQueue if threaded else \
+            transport_queue(transport, kw.get('ring_size'))
+
+        qi = [mkqueue() for _ in xrange(N)]
+        qo = [mkqueue() for _ in xrange(N)]
+        ring_bell(qo)
+
+    # Numpy arrays of at least this many bytes go to the worker processes
+    # through shared memory, see shm.py
+    share_arrays = kw.get('share_arrays', SHARE_THRESHOLD)
+    if have_numpy and share_arrays and not threaded and pool is None:
+        qi = sharing(qi, share_arrays)
+        qo = sharing(qo, share_arrays)
+
+    if pool is None:
+        workers = ts if threaded else ps
+    qo = Outputs(qo, workers)
+    route = dispatchers[dispatch](qo) if dispatch else None
+
+    try:
         # suspend
-        ins = await()
+        send(qo)
         # resume
 
-        if ins is not None:
-            idx, it = ins
-            qi[idx].put(it)
+        if threaded:
+            for i in xrange(N):
+                t = Thread(target=run_job,
+                        args=(qi[i], lines[i], qo[i], batch, linger_ms))
+                t.daemon = True
+                t.start()
+                ts.append(t)
+        elif pool is None:
+            for i in xrange(N):
+                parline = pctx(qi[i], lines[i], qo[i], batch, linger_ms)
+                p = Process(target=parline)
+                p.start()
+                ps.append(p)
 
+        while 1:
             # suspend
-            send(idx)
+            ins = await_many(batch) if batch else await()
             # resume
-        else:
-            for p in ps:
-                p.terminate()
-            close()
-            break
+
+            if not batch and ins is not None:
+                idx, it = ins
+                if route:
+                    idx = route(idx)
+                qo.ship(idx)
+                qi[idx].put(it)
+
+                # suspend
+                send(idx)
+                # resume
+            elif batch and ins and dispatch == 'steal':
+                # Shipped one by one, a Batch could only be taken whole
+                for idx, it in ins:
+                    qi[0].put(it)
+                qo.ship(0, len(ins))
+
+                # suspend
+                send_many([0] * len(ins))
+                # resume
+            elif batch and ins:
+                batches = {}
+                ids = []
+                for idx, it in ins:
+                    if route:
+                        idx = route(idx)
+                    qo.ship(idx)
+                    batches.setdefault(idx, Batch()).append(it)
+                    ids.append(idx)
+                for idx, items in batches.iteritems():
+                    qi[idx].put(items)
+
+                # suspend
+                send_many(ids)
+                # resume
+            else:
+                close()
+                break
+    finally:
+        if pool is not None:
+            pool.finish(job)
+        if threaded:
+            for q in qi:
+                q.put(EndOfJob)
+            for t in ts:
+                t.join()
+        for p in ps:
+            p.terminate()
+        # What was never read might hold shared arrays, which are
+        # released by reading them, on the way to the workers as well as
+        # back from them
+        if ps:
+            for q in qi + qo:
+                discard(q)
+        # A worker killed between sharing an array and putting it on its
+        # queue leaves a segment behind that nothing refers to
+        for p in ps:
+            p.join()
+            if have_numpy:
+                release(p.pid)
+
+# tpar :: [(a ~> b)] -> ([a] ~> [b])
+def tpar(*lines, **kw):
+    """
+    ``par`` with its pipelines run in threads of this process, for
+    stages that spend their time outside the GIL.
+    """
+    kw['executor'] = 'thread'
+    return par(*lines, **kw)
 
 def allgather(idx, qo):
     qs = await()
@@ -282,33 +1032,165 @@ def allgather(idx, qo):
         for i in read:
             send(i.recv())
 
+# gather hands on the results of the values par ships to its workers in
+# the order they were shipped. With ordered=False results are handed on
+# as soon as any worker has one, and with ordered=True and a window they
+# may overtake at most window-1 earlier results still being worked on.
+# Only the values par ships together, a batch, can be reordered, as
+# gather never holds a result back while it awaits par, which might not
+# be resumed again.
+
+def receive(qo, pending, idx, block=True, since=None):
+    # The next result of the worker idx, waited for since then
+    if not pending[idx]:
+        if since is None:
+            since = time.time()
+        if block:
+            item = get_live(qo[idx], qo.alive)
+        else:
+            item = qo[idx].get(block=False)
+        if type(item) is JobFailed:
+            raise RuntimeError("par worker %i failed:\n%s"
+                    % (idx, item.traceback))
+        if type(item) is Batch:
+            pending[idx].extend(item)
+        else:
+            pending[idx].append(item)
+        qo.waited(idx, time.time() - since, len(pending[idx]))
+    qo.outstanding[idx] -= 1
+    return pending[idx].popleft()
+
+def receive_any(qo, pending, workers):
+    # The next result of whichever of the workers has one first
+    since = time.time()
+    while 1:
+        # Checked first, so what a worker put before it died is read
+        dead = not qo.alive()
+        for idx in workers:
+            try:
+                return idx, receive(qo, pending, idx, False, since)
+            except Empty:
+                pass
+        if dead:
+            raise WorkerDied("A par worker died")
+
+        readers = [getattr(qo[idx], '_reader', None) for idx in workers]
+        bells = set(getattr(qo[idx], 'bell', None) for idx in workers)
+        if None not in readers:
+            select(readers, [], [], LIVENESS_INTERVAL)
+        elif len(bells) == 1 and None not in bells:
+            # Shared memory rings, wait for a record on any, see shm.py
+            bell = bells.pop()
+            if bell.acquire(True, LIVENESS_INTERVAL):
+                bell.release()
+        else:
+            # Thread queues, nothing to wait on at once
+            time.sleep(0.0005)
+
+def reorder(qo, pending, ids, window):
+    # The positions in ids still being worked on, per worker
+    outstanding = {}
+    for seq, idx in enumerate(ids):
+        outstanding.setdefault(idx, deque()).append(seq)
+
+    held = {}
+    sent = set()
+    # The earliest position not yet handed on
+    base = 0
+
+    while base < len(ids):
+        workers = [idx for idx in outstanding if outstanding[idx]]
+        idx, result = receive_any(qo, pending, workers)
+        held[outstanding[idx].popleft()] = result
+
+        for seq in sorted(held):
+            if seq >= base + window:
+                break
+            yield held.pop(seq)
+            sent.add(seq)
+            while base in sent:
+                sent.remove(base)
+                base += 1
+
 @flowlet
-def gather():
+def gather(ordered=True, window=None):
+    if window is not None and window < 1:
+        raise ValueError("gather() needs a positive window")
+    if not ordered:
+        window = float('inf')
+
     qo = await()
+    # Values from a Batch not handed on yet, per worker
+    pending = [deque() for _ in qo]
+
     while 1:
-        idx = await()
-        if idx is not None:
-            send(qo[idx].get())
+        if window is None:
+            idx = await()
+            if idx is None:
+                close()
+                break
+            send(receive(qo, pending, idx))
         else:
-            close()
-            break
+            ids = await_many(sys.maxsize)
+            if not ids:
+                close()
+                break
+            for result in reorder(qo, pending, ids, window):
+                send(result)
 
 # =================
 # Numeric Pipelines
 # =================
 
-def cythonpipe(f):
+# cythonpipe compiles the logic of a flowlet with Cython, the compiled
+# module is cached on disk and shared between processes, see
+# cythoncache.py
+
+def cythonpipe(f, cache_dir=None):
     if not have_cython:
         raise RuntimeError("Cython is not installed")
-    return flowlet(cython.compile(f))
+    return flowlet(compiled(f, cache_dir))
+
+# Compiled numexpr programs by expression, kept from one run to the next
+numexpr_programs = {}
+
+def numexpr_compile(f):
+    vm = numexpr_programs.get(f)
+    if vm is None:
+        vm = numexpr_programs[f] = numexpr.NumExpr(f)
+    return vm
+
+# With a batch the values ready upstream, up to batch of them, are packed
+# into arrays and evaluated at once. Scalars make up the one input of the
+# expression, records (tuples) one input per field in the order of
+# vm.input_names. The results are sent on one by one, or as the whole
+# array with emit='block'.
 
 @flowlet
-def numexpr_pipe(f):
+def numexpr_pipe(f, batch=None, emit='items'):
     if not have_numexpr:
         raise RuntimeError("Numexpr is not installed")
+    if emit not in ('items', 'block'):
+        raise ValueError("Unknown emit %r" % emit)
+
+    vm = numexpr_compile(f)
+
+    if not batch:
+        while 1:
+            inputs = await()
+            outputs = vm(inputs)
+            send(outputs)
 
-    vm = numexpr.NumExpr(f)
     while 1:
-        inputs = await()
-        outputs = vm(inputs)
-        send(outputs)
+        values = await_many(batch)
+        if not values:
+            break
+        if type(values[0]) is tuple:
+            outputs = vm(*map(numpy.array, zip(*values)))
+        else:
+            outputs = vm(numpy.array(values))
+
+        if emit == 'block':
+            send(outputs)
+        else:
+            send_many(outputs)
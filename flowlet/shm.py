@@ -0,0 +1,240 @@
+import os
+import mmap
+import struct
+import tempfile
+
+from Queue import Empty
+from functools import partial
+from cStringIO import StringIO
+from cPickle import dumps, loads, Pickler, Unpickler, HIGHEST_PROTOCOL
+from multiprocessing import Semaphore
+
+try:
+    import numpy
+    have_numpy = True
+except ImportError:
+    have_numpy = False
+
+# Shared Memory Ring
+# ==================
+
+# A single producer, single consumer queue over an anonymous shared
+# mapping, which must be created before the processes using it are
+# forked. Values are pickled straight into the ring as length prefixed
+# records, there is no feeder thread or pipe in between.
+#
+#   [ tail | data ... ]
+#
+# The write position is private to the producer and the read position
+# (tail) is published in the header for the producer to see how much
+# room is left. Waking up the other side is done with a pair of POSIX
+# semaphores, which only enter the kernel when someone has to block.
+#
+# A semaphore has no descriptor to select on along with others, so a
+# consumer of several rings can't wait on their items at once. Rings
+# given one bell, see ring_bell, also post it with every record and take
+# it back with every read, the bell counts the records of them all and
+# a consumer blocks on it until any of the rings has one. This costs a
+# second semaphore operation on either side per record.
+
+HEADER = struct.Struct('q')
+LENGTH = struct.Struct('i')
+
+class ShmQueue(object):
+
+    def __init__(self, size=1 << 22, bell=None):
+        self.size = size
+        self.ring = mmap.mmap(-1, HEADER.size + size)
+
+        # Records ready to be read
+        self.items = Semaphore(0)
+        # Posted on every read, the producer waits on it when full
+        self.space = Semaphore(0)
+        # Shared with other rings, posted along with items
+        self.bell = bell
+
+        self.head = 0
+
+    def _write(self, pos, data):
+        start = pos % self.size
+        end = start + len(data)
+        base = HEADER.size
+
+        if end <= self.size:
+            self.ring[base+start:base+end] = data
+        else:
+            split = self.size - start
+            self.ring[base+start:base+self.size] = data[:split]
+            self.ring[base:base+end-self.size] = data[split:]
+
+    def _read(self, pos, n):
+        start = pos % self.size
+        end = start + n
+        base = HEADER.size
+
+        if end <= self.size:
+            return self.ring[base+start:base+end]
+        else:
+            return (self.ring[base+start:base+self.size]
+                  + self.ring[base:base+end-self.size])
+
+    def put(self, obj):
+        data = dumps(obj, HIGHEST_PROTOCOL)
+        need = LENGTH.size + len(data)
+
+        if need > self.size:
+            raise ValueError("Value of %i bytes does not fit in a ring of %i, "
+                    "see ring_size" % (len(data), self.size))
+
+        # Keep the count of stale wakeups down
+        self.space.acquire(False)
+
+        tail, = HEADER.unpack_from(self.ring, 0)
+        while self.size - (self.head - tail) < need:
+            self.space.acquire()
+            tail, = HEADER.unpack_from(self.ring, 0)
+
+        self._write(self.head, LENGTH.pack(len(data)) + data)
+        self.head += need
+        # The bell goes first, a record can then always be read without
+        # waiting for it, even if we are killed in between
+        if self.bell is not None:
+            self.bell.release()
+        self.items.release()
+
+    def qsize(self):
+        return self.items.get_value()
+
+    def get(self, block=True, timeout=None):
+        if not self.items.acquire(block, timeout):
+            raise Empty
+        if self.bell is not None:
+            # Posted before items, never waits
+            self.bell.acquire()
+
+        # Read from the header rather than kept, so that the producer can
+        # drain what a consumer it has killed left behind
+        tail, = HEADER.unpack_from(self.ring, 0)
+        n, = LENGTH.unpack(self._read(tail, LENGTH.size))
+        data = self._read(tail + LENGTH.size, n)
+
+        HEADER.pack_into(self.ring, 0, tail + LENGTH.size + n)
+        self.space.release()
+        return loads(data)
+
+def ring_bell(queues, bell=None):
+    """
+    Give the shared memory rings among ``queues`` one bell, ``bell`` if
+    given, before any value is put on them. Returns the bell, None if
+    there are no rings and none was given.
+    """
+    rings = [q for q in queues if isinstance(q, ShmQueue)]
+    if not rings:
+        return bell
+    if bell is None:
+        bell = Semaphore(0)
+    for q in rings:
+        q.bell = bell
+    return bell
+
+# Shared Arrays
+# =============
+
+# Arrays of at least threshold bytes are not pickled along with the value
+# they are part of. They are picked out while the value is pickled, by a
+# persistent id hook which cPickle only calls for objects that are not of
+# the builtin types, so lists and tuples of plain values cost nothing
+# extra. Their data is written once to a segment of its own under
+# /dev/shm and only a descriptor is pickled, which maps the segment when
+# unpickled and gives an array over the mapping. The segment is unlinked
+# as soon as it is mapped and freed along with the array. Segments are
+# named after the process which made them, so that those a killed
+# process never got onto a queue can be found, see release.
+
+SHARE_THRESHOLD = 1 << 16
+SHARE_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+def attach(path, dtype, shape):
+    with open(path, 'rb') as f:
+        os.unlink(path)
+        if not os.fstat(f.fileno()).st_size:
+            return numpy.empty(shape, dtype)
+        # Private, so writing to the array doesn't write to the segment
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    return numpy.frombuffer(m, dtype).reshape(shape)
+
+def segment_prefix(pid):
+    return 'flowlet-%i-' % pid
+
+def release(pid):
+    """
+    Unlink the segments the process ``pid`` shared which were never
+    mapped, once it is gone and what it put on its queues has been read.
+    """
+    path = SHARE_DIR or tempfile.gettempdir()
+    prefix = segment_prefix(pid)
+    for name in os.listdir(path):
+        if name.startswith(prefix):
+            os.unlink(os.path.join(path, name))
+
+def shared_id(threshold, paths, obj):
+    if type(obj) is not numpy.ndarray:
+        return None
+    if obj.nbytes < threshold or obj.dtype.hasobject:
+        return None
+
+    array = numpy.ascontiguousarray(obj)
+    fd, path = tempfile.mkstemp(prefix=segment_prefix(os.getpid()),
+            dir=SHARE_DIR)
+    paths.append(path)
+    with os.fdopen(fd, 'wb') as f:
+        array.tofile(f)
+    return (path, array.dtype, array.shape)
+
+def dumps_shared(value, threshold):
+    """
+    ``value`` pickled with the large arrays in it put in shared memory.
+    """
+    paths = []
+    f = StringIO()
+    pickler = Pickler(f, HIGHEST_PROTOCOL)
+    pickler.inst_persistent_id = partial(shared_id, threshold, paths)
+    try:
+        pickler.dump(value)
+    except Exception:
+        for path in paths:
+            os.unlink(path)
+        raise
+    return f.getvalue()
+
+def loads_shared(data):
+    unpickler = Unpickler(StringIO(data))
+    unpickler.persistent_load = lambda descriptor: attach(*descriptor)
+    return unpickler.load()
+
+class SharingQueue(object):
+    """
+    A queue which shares the large arrays put on it, any other queue
+    operation is passed through to the queue it wraps.
+    """
+
+    def __init__(self, queue, threshold=SHARE_THRESHOLD):
+        self.queue = queue
+        self.threshold = threshold
+
+    def put(self, value, *args, **kwargs):
+        self.queue.put(dumps_shared(value, self.threshold), *args, **kwargs)
+
+    def get(self, *args, **kwargs):
+        return loads_shared(self.queue.get(*args, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self.queue, name)
+
+def sharing(queues, threshold):
+    # The same queue may appear more than once and stays the same queue
+    wrapped = {}
+    for q in queues:
+        if id(q) not in wrapped:
+            wrapped[id(q)] = SharingQueue(q, threshold)
+    return [wrapped[id(q)] for q in queues]
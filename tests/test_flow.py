@@ -1,7 +1,9 @@
 from gc import get_referents, collect
+from resource import getrusage, RUSAGE_SELF
+from sys import getrefcount
 
 from flowlet.flow import flowlet, getcurrent, await, send, suspend, \
-    close, FlowletExit, BlockedUpstream
+    close, send_many, await_many, pool_stats, FlowletExit, BlockedUpstream
 from nose.tools import assert_raises
 from unittest2 import skip
 from weakref import ref
@@ -89,6 +91,31 @@ def test_greenlet_linking3():
 
     assert getcurrent() == None
 
+def test_getcurrent_interleaved():
+    seen = []
+
+    def M():
+        while 1:
+            seen.append(('m', getcurrent()))
+            send(1)
+
+    def N():
+        while 1:
+            await()
+            seen.append(('n', getcurrent()))
+            send(2)
+
+    m = flowlet(M)
+    n = flowlet(N)
+    n.bind(m)
+
+    for i in range(3):
+        assert n.await() == 2
+        # Outside of any flowlet again
+        assert getcurrent() == None
+
+    assert seen == [('m', m), ('n', n)] * 3
+
 def test_flowlet_send():
     def M():
         assert await() == 1
@@ -118,6 +145,237 @@ def test_flowlet_await():
     assert f.await() == 2
     assert f.await() == 3
 
+def test_send_many():
+    def M():
+        send_many([1,2,3])
+        send(4)
+
+    f = flowlet(M)
+
+    assert f.await() == 1
+    assert f.await() == 2
+    assert f.await() == 3
+    assert f.await() == 4
+
+def test_send_many_empty():
+    def M():
+        send_many([])
+        send(1)
+
+    f = flowlet(M)
+    assert f.await() == 1
+
+def test_send_many_bound():
+
+    def A():
+        send_many(xrange(3))
+        send(3)
+
+    def B():
+        while True:
+            send(await() * 10)
+
+    a = flowlet(A)
+    b = flowlet(B)
+
+    b.bind(a)
+    assert [b.await() for _ in xrange(4)] == [0, 10, 20, 30]
+
+def test_await_many():
+
+    def A():
+        send_many(range(10))
+
+    def B():
+        send(await_many(4))
+        send(await_many(4))
+        send(await_many(100))
+
+    a = flowlet(A)
+    b = flowlet(B)
+
+    b.bind(a)
+    assert b.await() == [0,1,2,3]
+    assert b.await() == [4,5,6,7]
+    assert b.await() == [8,9]
+
+def test_await_many_unbuffered():
+
+    def A():
+        send(1)
+        send(2)
+
+    def B():
+        send(await_many(5))
+
+    a = flowlet(A)
+    b = flowlet(B)
+
+    b.bind(a)
+    assert b.await() == [1]
+
+def test_flowlet_send_many():
+    def M():
+        send(await() + await() * 10 + await() * 100)
+
+    f = flowlet(M)
+    f.send_many([1,2,3])
+    assert f.await() == 321
+
+def test_flowlet_await_many():
+    def M():
+        send_many([1,2,3])
+        send(4)
+
+    f = flowlet(M)
+    assert f.await_many(2) == [1,2]
+    assert f.await_many(2) == [3]
+    assert f.await_many(2) == [4]
+
+def test_flowlet_await_many_refcount():
+    x = object()
+
+    def M():
+        while True:
+            send(x)
+
+    f = flowlet(M)
+    f.await_many(1)
+    before = getrefcount(x)
+    for _ in xrange(1000):
+        f.await_many(1)
+    assert getrefcount(x) == before
+
+def test_buffered_send():
+
+    trace = []
+
+    def A():
+        for i in xrange(6):
+            trace.append(i)
+            send(i)
+
+    def B():
+        while True:
+            x = await()
+            trace.append('b%s' % x)
+            send(x)
+
+    a = flowlet(A)
+    b = flowlet(B)
+    b.buffer = 3
+
+    b.bind(a)
+    assert [b.await() for _ in xrange(6)] == range(6)
+
+    # Upstream fills the buffer before each switch
+    assert trace == [0, 1, 2, 'b0', 'b1', 'b2', 3, 4, 5, 'b3', 'b4', 'b5']
+
+def test_buffered_flush():
+
+    def A():
+        for i in xrange(5):
+            send(i)
+
+    def B():
+        while True:
+            send(await_many(3))
+
+    a = flowlet(A)
+    b = flowlet(B)
+    b.buffer = 3
+
+    b.bind(a)
+
+    # The tail left in the buffer when A returns is still delivered
+    assert list(iter(b.await, None)) == [[0,1,2], [3,4]]
+
+def test_buffer_invalid():
+    f = flowlet(lambda: None)
+    assert f.buffer == 0
+
+    with assert_raises(ValueError):
+        f.buffer = -1
+
+def test_await_memory():
+    # Steady state switching must not allocate, 10M awaits should leave
+    # both the shared empty tuple and the resident set untouched.
+
+    def M():
+        i = 0
+        while 1:
+            send(i)
+            i += 1
+
+    def N(n):
+        for i in xrange(n):
+            await()
+        send(n)
+
+    def run(n):
+        m = flowlet(M)
+        c = flowlet(N, n)
+        c.bind(m)
+        assert c.await() == n
+
+    run(10**5)
+
+    refs = getrefcount(())
+    rss = getrusage(RUSAGE_SELF).ru_maxrss
+
+    run(10**7)
+
+    assert getrefcount(()) - refs < 10
+    # ru_maxrss is in kilobytes
+    assert getrusage(RUSAGE_SELF).ru_maxrss - rss < 4096
+
+def test_pool_stats():
+
+    def M():
+        while 1:
+            send(await() + 1)
+
+    def run():
+        m = flowlet(M)
+        m.bind([1, 2, 3])
+        assert list(m) == [2, 3, 4]
+
+    run()
+    before = pool_stats()
+    run()
+    after = pool_stats()
+
+    # A finished flowlet hands both itself and its greenlet back, the
+    # greenlet only with the greenlet release the pool knows
+    assert after['flowlet_hits'] == before['flowlet_hits'] + 1
+    assert after['flowlet_free'] == before['flowlet_free']
+    assert after['greenlet_free'] == before['greenlet_free']
+
+    if after['greenlet_pooling']:
+        assert after['greenlet_hits'] == before['greenlet_hits'] + 1
+    else:
+        assert after['greenlet_misses'] == before['greenlet_misses'] + 1
+
+def test_pool_suspended():
+    cleanup = []
+
+    def M():
+        try:
+            while 1:
+                send(1)
+        finally:
+            cleanup.append(True)
+
+    m = flowlet(M)
+    assert m.await() == 1
+
+    # Dropping a flowlet suspended mid-run unwinds it rather than
+    # recycling its greenlet
+    before = pool_stats()
+    del m
+    assert cleanup == [True]
+    assert pool_stats()['greenlet_free'] == before['greenlet_free']
+
 def test_flowlet_init():
     def M(x):
         send(x)
@@ -365,6 +623,64 @@ def test_binding():
     assert n.switch() == 2
     assert n.switch() == 3
 
+def test_binding_iterator():
+
+    def N():
+        while 1:
+            send(await() * 2)
+
+    n = flowlet(N)
+    n.bind([1, 2, 3])
+
+    assert list(n) == [2, 4, 6]
+
+def test_binding_iterator_lazy():
+    pulled = []
+
+    def source():
+        for i in range(3):
+            pulled.append(i)
+            yield i
+
+    def N():
+        send(await())
+
+    n = flowlet(N)
+    n.bind(source())
+
+    # Nothing is read until the flowlet awaits
+    assert pulled == []
+    assert n.await() == 0
+    assert pulled == [0]
+
+def test_binding_iterator_error():
+
+    def source():
+        yield 1
+        raise RuntimeError("Boom")
+
+    def N():
+        while 1:
+            send(await())
+
+    n = flowlet(N)
+    n.bind(source())
+
+    assert n.await() == 1
+    with assert_raises(RuntimeError):
+        n.await()
+
+def test_await_many_iterator():
+
+    def N():
+        while 1:
+            send(await_many(4))
+
+    n = flowlet(N)
+    n.bind(iter(range(10)))
+
+    assert list(n) == [[0,1,2,3], [4,5,6,7], [8,9]]
+
 def test_finalize1():
 
     def M():
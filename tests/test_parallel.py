@@ -1,12 +1,26 @@
 import _multiprocessing
+import threading
 import os
+import time
+import signal
+import socket
+import shutil
+import tempfile
+from itertools import count
 
 from flowlet.flowlet import *
 from flowlet.prelude import *
 from flowlet.pipeline import *
 from flowlet.flow import exhaust, await, send, Id
 
+from Queue import Empty
+from contextlib import closing, contextmanager
+from select import select
+from cPickle import PicklingError
+from nose.tools import assert_raises
 from unittest2 import skip
+from flowlet.shm import ShmQueue, ring_bell
+from multiprocessing.queues import Queue as MPQueue
 
 # =========
 # Unix Pipe
@@ -48,6 +62,261 @@ def test_pipe_close():
 
     assert r.closed
 
+def test_ipcframes():
+    fd1, fd2 = os.pipe()
+    r = _multiprocessing.Connection(fd1, writable=False)
+    w = _multiprocessing.Connection(fd2, readable=False)
+
+    for msg in ('foo', 'x' * 100, '', 'bar'):
+        w.send_bytes(msg)
+    w.close()
+
+    a = ipcframes(r, buffers=2, size=8)
+    b = pipe(lambda frame: frame.tobytes())
+
+    result = runPipeline(a >> b)
+    assert result == ['foo', 'x' * 100, '', 'bar']
+    assert r.closed
+
+# =======
+# Sockets
+# =======
+
+def test_sock_eof():
+    r, w = socket.socketpair()
+    w.sendall('foobar')
+    w.close()
+
+    result = runPipeline(sockpipe(r) >> pipe(str))
+    assert ''.join(result) == 'foobar'
+
+def test_sockframes():
+    r, w = socket.socketpair()
+    messages = ['foo', '', 'x' * 100, 'bar', 'y' * 20]
+    data = ''.join(map(frame, messages))
+
+    # Written a few bytes at a time, frames are split across reads
+    for i in xrange(0, len(data), 7):
+        w.sendall(data[i:i+7])
+    w.close()
+
+    a = sockframes(r, buffers=2, size=16)
+    b = pipe(lambda frame: frame.tobytes())
+
+    result = runPipeline(a >> b)
+    assert result == messages
+
+def test_sockframes_truncated():
+    r, w = socket.socketpair()
+    w.sendall(frame('foobar')[:-1])
+    w.close()
+
+    with assert_raises(EOFError):
+        runPipeline(sockframes(r) >> pipe(lambda frame: frame.tobytes()))
+
+def test_frameput():
+    r, w = socket.socketpair()
+
+    runPipeline(['foo', 'bar', buffer('baz')] >> frameput(w, batch=2))
+    w.close()
+
+    result = runPipeline(sockframes(r) >> pipe(lambda frame: frame.tobytes()))
+    assert result == ['foo', 'bar', 'baz']
+
+def test_frameput_none():
+    r, w = socket.socketpair()
+
+    runPipeline([None, 'foo'] >> frameput(w))
+    w.close()
+
+    result = runPipeline(sockframes(r) >> pipe(lambda frame: frame.tobytes()))
+    assert result == ['None', 'foo']
+
+# ===
+# Hub
+# ===
+
+@flowlet
+def writer(sock, messages):
+    with closing(sock):
+        for msg in messages:
+            sock.sendall(msg)
+
+def test_hub_interleaved():
+    r, w = socket.socketpair()
+
+    # The first would block for good without a hub, the second is what
+    # writes to it
+    with Hub() as hub:
+        a = hub.spawn(sockframes(r) >> pipe(lambda f: f.tobytes()))
+        b = hub.spawn(writer(w, map(frame, ['foo', 'bar'])))
+
+        result = hub.run()
+        assert a.value == ['foo', 'bar']
+        assert result == [a.value, []]
+
+def test_hub_many():
+    N = 100
+    pairs = [socket.socketpair() for _ in xrange(N)]
+
+    with Hub() as hub:
+        tasks = [hub.spawn(sockpipe(r) >> pipe(str)) for r, w in pairs]
+        for i, (r, w) in reversed(list(enumerate(pairs))):
+            hub.spawn(writer(w, [str(i)]))
+
+        hub.run()
+        assert [''.join(task.value) for task in tasks] == map(str, xrange(N))
+
+def test_hub_queue():
+    q = Queue()
+
+    @flowlet
+    def producer():
+        q.put(1)
+        q.put(2)
+
+    with Hub() as hub:
+        a = hub.spawn(queuepipe(q) >> take(2))
+        b = hub.spawn(producer())
+
+        hub.run()
+        assert a.value == [1, 2]
+
+def test_hub_timeout():
+    r, w = socket.socketpair()
+
+    @flowlet
+    def waiter(sock):
+        send(wait_read(sock, timeout=0.01))
+        w.sendall('x')
+        send(wait_read(sock, timeout=1))
+
+    with Hub() as hub:
+        assert hub.run() == []
+        hub.spawn(waiter(r) >> take(2))
+        assert hub.run() == [[False, True]]
+
+def test_hub_errors():
+    r, w = socket.socketpair()
+    w.sendall('foo')
+    w.close()
+
+    def fail(x):
+        raise KeyError(x)
+
+    with Hub() as hub:
+        a = hub.spawn(sockpipe(r) >> pipe(fail))
+        b = hub.spawn([1, 2] >> pipe(lambda x: x))
+
+        with assert_raises(KeyError):
+            hub.run()
+        assert b.value == [1, 2]
+
+def test_hub_step():
+    r, w = socket.socketpair()
+
+    with Hub() as hub:
+        a = hub.spawn(sockpipe(r) >> take(1))
+        done = []
+        a.add_done_callback(done.append)
+
+        # Driven from outside, as another event loop would
+        assert hub.step()
+        assert not a.done
+
+        w.sendall('foo')
+        assert select([hub], [], [], 1)[0]
+        assert not hub.step()
+        assert done == [a]
+        assert a.result() == ['foo']
+
+def test_channel():
+    ch = Channel()
+
+    with Hub() as hub:
+        a = hub.spawn(chanpipe(ch) >> pipe(lambda x: x * 2))
+        assert hub.step()
+
+        ch.put(1)
+        ch.put(2)
+        assert hub.step()
+        ch.close()
+        assert not hub.step()
+        assert a.result() == [2, 4]
+
+def test_channel_waiters():
+    ch = Channel()
+
+    with Hub() as hub:
+        a = hub.spawn(chanpipe(ch))
+        b = hub.spawn(chanpipe(ch))
+        assert hub.step()
+
+        # Both wait on the channel, neither is forgotten
+        ch.put(1)
+        hub.step()
+        ch.put(2)
+        ch.put(3)
+        hub.step()
+        ch.close()
+        assert not hub.step()
+        assert sorted(a.result() + b.result()) == [1, 2, 3]
+
+    with Hub() as hub:
+        ch = Channel()
+        hub.spawn(chanpipe(ch))
+        hub.spawn(chanpipe(ch))
+        hub.spawn(range(3) >> chanput(ch))
+        assert sorted(sum(hub.run(), [])) == [0, 1, 2]
+
+def test_chanput():
+    ch = Channel()
+
+    with Hub() as hub:
+        a = hub.spawn(chanpipe(ch) >> pipe(lambda x: x + 1))
+        hub.spawn(range(3) >> chanput(ch))
+        assert hub.run() == [[1, 2, 3], []]
+
+def test_chanput_none():
+    ch = Channel()
+
+    with Hub() as hub:
+        hub.spawn([None, 1] >> chanput(ch))
+        hub.run()
+        assert list(ch.items) == [None, 1]
+        assert ch.closed
+
+def test_channel_never_filled():
+    with Hub() as hub:
+        hub.spawn(chanpipe(Channel()))
+        with assert_raises(RuntimeError):
+            hub.run()
+
+        with assert_raises(RuntimeError):
+            runPipeline(chanpipe(Channel()))
+
+def test_hub_close():
+    r, w = socket.socketpair()
+    w.sendall('foo')
+    w.close()
+
+    # Nothing is opened until a pipeline waits
+    hub = Hub()
+    assert hub.epoll is None
+
+    with hub:
+        hub.spawn(sockpipe(r))
+        hub.run()
+        fd = hub.fileno()
+        os.fstat(fd)
+    assert hub.epoll is None
+    with assert_raises(OSError):
+        os.fstat(fd)
+
+def test_wait_read_no_hub():
+    r, w = socket.socketpair()
+    assert wait_read(r)
+
 # ===========
 # Parallelism
 # ===========
@@ -62,7 +331,40 @@ def test_scatter2():
     pipe = [1,2,3] >> scatter(3)
 
     result = runPipeline(pipe)
-    assert result == [(0,[1,2,3])]
+    assert result == [(0,[1]), (1,[2]), (2,[3])]
+
+def ident(xs):
+    return xs
+
+def test_scatter_after_flowlet():
+    inc = lambda x: x + 1
+
+    result = runPipeline(range(6) >> pipe(inc) >> scatter(2) >> pipe(ident))
+    assert result == [(0,[1]), (1,[2]), (0,[3]), (1,[4]), (0,[5]), (1,[6])]
+
+    line = range(6) >> pipe(inc) >> scatter(2) >> par(pipe(ident), N=2) >> gather()
+    assert runPipeline(line) == [[1], [2], [3], [4], [5], [6]]
+
+def test_scatter_chunk():
+    pipe = [1,2,3,4,5] >> scatter(2, chunk=2)
+
+    result = runPipeline(pipe)
+    assert result == [(0,[1,2]), (1,[3,4]), (0,[5])]
+
+def test_scatter_lazy():
+    pipe = count() >> scatter(2, chunk=3) >> take(2)
+
+    result = runPipeline(pipe)
+    assert result == [(0,[0,1,2]), (1,[3,4,5])]
+
+def test_scatter_par():
+    line = (
+        count() >> scatter(2, chunk=4)
+        >> par(pipe(double), N=2)
+        >> gather() >> take(3)
+    )
+    result = runPipeline(line)
+    assert result == [[0,2,4,6], [8,10,12,14], [16,18,20,22]]
 
 def test_roundrobin():
     pipe = [1,2,3,4] >> roundrobin(2)
@@ -70,6 +372,17 @@ def test_roundrobin():
     result = runPipeline(pipe)
     assert result == [(0,1), (1,2), (2,3), (3,4)]
 
+def test_lazy_between_flowlets():
+    # A generator reading from a flowlet and read by another cannot be
+    # run, but tearing it down has to raise rather than crash
+    line = count() >> pipe(id) >> roundrobin(2) >> pipe(id) >> take(3)
+    with assert_raises(ValueError):
+        runPipeline(line)
+
+    line = range(5) >> pipe(id) >> roundrobin(2) >> pipe(id)
+    with assert_raises(ValueError):
+        runPipeline(line)
+
 def test_parallel():
 
     task1 = pipe(lambda x: x*1)
@@ -137,3 +450,491 @@ def test_gather():
 
     result = runPipeline(line)
     assert result == [[1], [2], [3], [4]]
+
+def test_parallel_shm():
+    N = 2
+    task1 = pipe(lambda xs: [x*2 for x in xs])
+
+    line = (
+        range(100) >> scatter(1)
+        >> par(task1, N=N, transport='shm')
+        >> gather()
+    )
+    result = runPipeline(line)
+    assert sorted(sum(result, [])) == range(0, 200, 2)
+
+def test_parallel_ring_size():
+    big = ['x' * (5 << 20)]
+
+    line = [(0, big)] >> par(idLazy(), transport='shm') >> gather()
+    with assert_raises(ValueError):
+        runPipeline(line)
+
+    line = [(0, big)] >> par(idLazy(), transport='shm', ring_size=8 << 20) >> gather()
+    assert runPipeline(line) == [big]
+
+    with WorkerPool(1, transport='shm', ring_size=8 << 20) as pool:
+        line = [(0, big)] >> par(idLazy(), pool=pool) >> gather()
+        assert runPipeline(line) == [big]
+
+def test_parallel_transport_invalid():
+    line = [1,2] >> scatter(1) >> par(idLazy(), transport='carrier pigeon')
+
+    with assert_raises(ValueError):
+        runPipeline(line)
+
+def test_shm_queue():
+    q = ShmQueue(size=64)
+
+    # Wraps around the end of the ring many times over
+    for i in xrange(1000):
+        q.put((i, 'x' * (i % 20)))
+        assert q.get() == (i, 'x' * (i % 20))
+
+    with assert_raises(Empty):
+        q.get(block=False)
+
+    with assert_raises(ValueError):
+        q.put('x' * 64)
+
+def test_shm_ring_bell():
+    qs = [ShmQueue(size=256) for _ in range(3)]
+    bell = ring_bell(qs + [Queue()])
+
+    def produce():
+        qs[2].put('a')
+        qs[0].put('b')
+
+    p = Process(target=produce)
+    p.start()
+
+    # Blocks until the records are there, counts them all
+    bell.acquire()
+    bell.release()
+    p.join()
+    assert bell.get_value() == 2
+    assert qs[2].get() == 'a'
+    assert qs[0].get() == 'b'
+    assert bell.get_value() == 0
+    assert ring_bell([Queue()]) is None
+
+def test_shm_queue_processes():
+    q = ShmQueue(size=256)
+
+    def produce():
+        for i in xrange(500):
+            q.put(i)
+
+    p = Process(target=produce)
+    p.start()
+
+    # Far more than fits in the ring, nothing is read until the producer
+    # has filled it and blocks waiting for space
+    p.join(0.5)
+    assert p.is_alive()
+
+    assert [q.get() for _ in xrange(500)] == range(500)
+    p.join()
+
+def double(xs):
+    return [x*2 for x in xs]
+
+def test_pool_par():
+    with WorkerPool(2) as pool:
+        pids = [p.pid for p in pool.workers]
+
+        for i in xrange(3):
+            line = (
+                range(10) >> scatter(1)
+                >> par(pipe(double), N=2, pool=pool)
+                >> gather()
+            )
+            result = runPipeline(line)
+            assert sorted(sum(result, [])) == range(0, 20, 2)
+
+        # Leaves output behind which the next job must not see
+        line = range(10) >> scatter(1) >> par(pipe(double), pool=pool)
+        runPipeline(line >> take(2))
+
+        line = [5] >> scatter(1) >> par(pipe(double), pool=pool) >> gather()
+        assert runPipeline(line) == [[10]]
+
+        assert [p.pid for p in pool.workers] == pids
+
+def fail_on_three(xs):
+    if 3 in xs:
+        raise ValueError(xs)
+    return xs
+
+def test_pool_error():
+    with WorkerPool(2) as pool:
+        line = (
+            range(10) >> scatter(2)
+            >> par(pipe(fail_on_three), N=2, pool=pool)
+            >> gather()
+        )
+        with assert_raises(RuntimeError):
+            runPipeline(line)
+
+        # Nothing of the failed job is left for the next one
+        line = range(4) >> scatter(2) >> par(pipe(double), N=2, pool=pool) >> gather()
+        assert runPipeline(line) == [[0], [2], [4], [6]]
+
+def die_on_three(xs):
+    if 3 in xs:
+        os.kill(os.getpid(), signal.SIGKILL)
+    return xs
+
+def test_pool_dead_worker():
+    for transport in ('queue', 'shm'):
+        with WorkerPool(2, transport=transport) as pool:
+            pid = pool.workers[0].pid
+            os.kill(pid, signal.SIGKILL)
+            pool.workers[0].join()
+
+            # The dead worker is replaced before the next job
+            line = range(4) >> scatter(1) >> par(pipe(double), N=2, pool=pool) >> gather()
+            assert runPipeline(line) == [[0], [2], [4], [6]]
+            assert pool.workers[0].pid != pid
+
+            # One that dies during a job fails it rather than hanging
+            line = (
+                range(10) >> scatter(1)
+                >> par(pipe(die_on_three), N=2, pool=pool)
+                >> gather()
+            )
+            with assert_raises(WorkerDied):
+                runPipeline(line)
+
+            line = range(4) >> scatter(1) >> par(pipe(double), N=2, pool=pool) >> gather()
+            assert runPipeline(line) == [[0], [2], [4], [6]]
+
+def test_parallel_dead_worker():
+    for transport in ('queue', 'shm'):
+        for ordered in (True, False):
+            line = (
+                range(10) >> scatter(1)
+                >> par(pipe(die_on_three), N=2, transport=transport)
+                >> gather(ordered=ordered)
+            )
+            with assert_raises(WorkerDied):
+                runPipeline(line)
+
+def test_pool_unpicklable():
+    with WorkerPool(1) as pool:
+        line = [1] >> scatter(1) >> par(pipe(lambda x: x), pool=pool)
+
+        with assert_raises(PicklingError):
+            runPipeline(line)
+
+def test_pool_too_small():
+    with WorkerPool(1) as pool:
+        line = [1] >> scatter(1) >> par(idLazy(), N=2, pool=pool)
+
+        with assert_raises(ValueError):
+            runPipeline(line)
+
+def test_parallel_batch():
+    task1 = pipe(double)
+
+    for transport in ('queue', 'shm'):
+        line = (
+            range(100) >> scatter(1)
+            >> par(task1, N=1, batch=8, transport=transport)
+            >> gather()
+        )
+        result = runPipeline(line)
+        assert result == [[2*i] for i in range(100)]
+
+class CountingQueue(MPQueue):
+
+    def __init__(self):
+        MPQueue.__init__(self)
+        self.puts = 0
+        counted.append(self)
+
+    def put(self, obj, *args):
+        self.puts += 1
+        MPQueue.put(self, obj, *args)
+
+counted = []
+
+def test_parallel_batch_messages():
+    # Puts on the worker outputs are made in the workers, only those on
+    # the inputs are counted here
+    del counted[:]
+    transports['counting'] = CountingQueue
+    try:
+        line = (
+            range(100) >> scatter(1)
+            >> par(pipe(double), N=1, batch=8, transport='counting')
+            >> gather()
+        )
+        assert runPipeline(line) == [[2*i] for i in range(100)]
+    finally:
+        del transports['counting']
+    assert sum(q.puts for q in counted) == 13
+
+def test_parallel_linger():
+    task1 = pipe(double)
+
+    line = (
+        range(10) >> scatter(1)
+        >> par(task1, N=1, batch=1000, linger_ms=0)
+        >> gather()
+    )
+    result = runPipeline(line)
+    assert result == [[2*i] for i in range(10)]
+
+def test_pool_batch():
+    with WorkerPool(1) as pool:
+        line = (
+            range(20) >> scatter(1)
+            >> par(pipe(double), pool=pool, batch=3)
+            >> gather()
+        )
+        assert runPipeline(line) == [[2*i] for i in range(20)]
+
+def test_batcher():
+    q = Queue()
+    b = Batcher(q, 2)
+
+    assert b.put(1) == 0
+    assert b.put(2) == 2
+    assert b.put(3) == 0
+    assert b.flush() == 1
+    assert b.flush() == 0
+
+    assert q.get() == [1, 2]
+    assert q.get() == [3]
+
+def skewed(**kw):
+    import time
+
+    def slow(x):
+        time.sleep(0.2)
+        return x
+
+    # Worker 0 is slow, worker 1 is fast
+    items = [(0, 'a'), (1, 'b'), (1, 'c')]
+    line = items >> par(pipe(slow), pipe(Id), batch=3) >> gather(**kw)
+    return runPipeline(line)
+
+def test_gather_unordered():
+    assert skewed(ordered=False) == ['b', 'c', 'a']
+
+def test_gather_ordered():
+    assert skewed() == ['a', 'b', 'c']
+    assert skewed(window=1) == ['a', 'b', 'c']
+
+def test_gather_window():
+    assert skewed(window=2) == ['b', 'a', 'c']
+
+def test_gather_unordered_scatter():
+    import time
+
+    def slow(xs):
+        time.sleep(0.2)
+        return xs
+
+    # Worker 0 is slow, the batch is filled through scatter
+    line = (
+        ['a', 'b', 'c', 'd'] >> scatter(2)
+        >> par(pipe(slow), pipe(Id), batch=4)
+        >> gather(ordered=False)
+    )
+    assert runPipeline(line) == [['b'], ['d'], ['a'], ['c']]
+
+def test_gather_unordered_shm():
+    task1 = pipe(double)
+
+    line = (
+        [(i % 2, [i]) for i in range(50)]
+        >> par(task1, N=2, batch=8, transport='shm')
+        >> gather(ordered=False)
+    )
+    result = runPipeline(line)
+    assert sorted(result) == [[2*i] for i in range(50)]
+
+def test_dispatch_roundrobin():
+    # Every value is tagged for worker 0 upstream
+    items = [(0, [i]) for i in range(10)]
+    line = items >> par(pipe(double), N=2, dispatch='roundrobin') >> gather()
+
+    result = runPipeline(line)
+    assert result == [[2*i] for i in range(10)]
+
+def test_dispatch_least_loaded():
+    for transport in ('queue', 'shm'):
+        items = [(0, [i]) for i in range(20)]
+        line = items >> par(pipe(double), N=3, batch=4,
+                dispatch='least_loaded', transport=transport) >> gather()
+
+        result = runPipeline(line)
+        assert result == [[2*i] for i in range(20)]
+
+def test_dispatch_steal():
+    items = [(0, [i]) for i in range(20)]
+    line = (
+        items >> par(pipe(double), N=3, batch=4, dispatch='steal')
+        >> gather(ordered=False)
+    )
+    result = runPipeline(line)
+    assert sorted(result) == [[2*i] for i in range(20)]
+
+def test_dispatch_least_loaded_route():
+    qo = Outputs([None] * 3)
+    qo.latency = [1.0, 2.0, 1.0]
+    qo.outstanding = [2, 0, 1]
+
+    route = least_loaded_dispatch(qo)
+    assert route(0) == 1
+    qo.outstanding[1] = 2
+    assert route(0) == 2
+
+def tag_slow(xs):
+    time.sleep(0.02)
+    return ('slow', xs)
+
+def tag_fast(xs):
+    return ('fast', xs)
+
+def test_dispatch_least_loaded_slow():
+    # The slow worker keeps on being the most loaded, across rounds of
+    # par and gather as well as within a batch
+    for batch, ordered in [(None, True), (4, True), (4, False)]:
+        items = [(0, [i]) for i in range(40)]
+        line = items >> par(pipe(tag_slow), pipe(tag_fast), batch=batch,
+                dispatch='least_loaded') >> gather(ordered=ordered)
+
+        result = runPipeline(line)
+        assert sorted(xs for _, xs in result) == [[i] for i in range(40)]
+        tags = [tag for tag, _ in result]
+        assert tags.count('slow') < 5
+
+def test_dispatch_invalid():
+    line = [(0, 1)] >> par(idLazy(), dispatch='steal', transport='shm')
+
+    with assert_raises(ValueError):
+        runPipeline(line)
+
+def test_tpar():
+    line = range(20) >> scatter(2) >> tpar(pipe(double), N=2) >> gather()
+
+    result = runPipeline(line)
+    assert result == [[2*i] for i in range(20)]
+
+def test_tpar_batch():
+    for dispatch in (None, 'least_loaded', 'steal'):
+        line = (
+            range(20) >> scatter(3)
+            >> par(pipe(double), N=3, executor='thread', batch=4,
+                dispatch=dispatch)
+            >> gather(ordered=False)
+        )
+        result = runPipeline(line)
+        assert sorted(result) == [[2*i] for i in range(20)]
+
+def test_tpar_take():
+    line = count() >> scatter(2) >> tpar(pipe(double), N=2) >> gather()
+
+    result = runPipeline(line >> take(3))
+    assert result == [[0], [2], [4]]
+
+def test_tpar_threads_exit():
+    before = threading.active_count()
+
+    line = range(4) >> scatter(2) >> tpar(idLazy(), N=2) >> gather()
+    runPipeline(line)
+
+    for t in threading.enumerate():
+        if t is not threading.current_thread():
+            t.join(1)
+    assert threading.active_count() == before
+
+@contextmanager
+def segments_dir():
+    # Segments go to a directory of this test's own, as other processes
+    # may be sharing arrays at the same time
+    import flowlet.shm as shm
+
+    path = tempfile.mkdtemp(dir=shm.SHARE_DIR)
+    old, shm.SHARE_DIR = shm.SHARE_DIR, path
+    try:
+        yield path
+    finally:
+        shm.SHARE_DIR = old
+        shutil.rmtree(path)
+
+def test_share_arrays():
+    from numpy import arange
+    from flowlet.shm import dumps_shared, loads_shared
+
+    a = arange(100000.0)
+    with segments_dir() as path:
+        data = dumps_shared([(1, a), a[:10]], 1024)
+        assert len(os.listdir(path)) == 1
+        value = loads_shared(data)
+        assert os.listdir(path) == []
+
+    assert (value[0][1] == a).all() and not value[0][1].flags.owndata
+    assert value[1].flags.owndata
+
+    # Private to the receiver
+    value[0][1][0] = 42
+    assert a[0] == 0
+
+def test_share_arrays_unpicklable():
+    from numpy import arange
+    from flowlet.shm import dumps_shared
+
+    with segments_dir() as path:
+        with assert_raises(PicklingError):
+            dumps_shared([arange(100000.0), lambda: None], 1024)
+        assert os.listdir(path) == []
+
+def test_shm_queue_drain_producer():
+    q = ShmQueue(size=256)
+    for i in xrange(5):
+        q.put(i)
+
+    def consume():
+        q.get()
+        q.get()
+
+    p = Process(target=consume)
+    p.start()
+    p.join()
+
+    # The producer takes over where the consumer left off
+    assert [q.get(block=False) for _ in xrange(3)] == [2, 3, 4]
+
+def test_parallel_arrays():
+    from numpy import ones
+
+    def view(xs):
+        return [(x.sum(), x.flags.owndata) for x in xs]
+
+    with segments_dir() as path:
+        for transport in ('queue', 'shm'):
+            line = (
+                [ones((300, 300)) * i for i in range(4)] >> scatter(2)
+                >> par(pipe(view), N=2, transport=transport) >> gather()
+            )
+            result = runPipeline(line)
+            assert result == [[(90000.0 * i, False)] for i in range(4)]
+        assert os.listdir(path) == []
+
+def test_parallel_arrays_take():
+    from numpy import ones
+
+    with segments_dir() as path:
+        for transport in ('queue', 'shm'):
+            # Results are left on the worker outputs mid batch
+            line = (
+                [ones((300, 300)) * i for i in range(8)] >> scatter(2)
+                >> par(pipe(ident), N=2, batch=4, transport=transport)
+                >> gather() >> take(1)
+            )
+            assert len(runPipeline(line)) == 1
+        assert os.listdir(path) == []
@@ -1,5 +1,9 @@
 import _multiprocessing
+import sys
 import os
+import glob
+import shutil
+import tempfile
 from itertools import count
 import threading
 from operator import add
@@ -12,7 +16,7 @@ from unittest2 import skip
 from flowlet.flowlet import *
 from flowlet.prelude import *
 from flowlet.pipeline import *
-from flowlet.flow import exhaust, await, send, Id
+from flowlet.flow import exhaust, await, send, Id, send_many, await_many
 
 # For static resources, :-/
 os.chdir(os.path.dirname(os.path.abspath( __file__)))
@@ -280,6 +284,72 @@ def test_flowlet_combine():
     result = runPipeline(a >> b >> c)
     assert result == [(1,2), (3,4)]
 
+def test_flowlet_send_many():
+
+    @flowlet
+    def unchunk():
+        while True:
+            send_many(await())
+
+    line = [[1,2], [3], [4,5,6]] >> unchunk() >> pipe(lambda x: x+1)
+
+    result = runPipeline(line)
+    assert result == [2,3,4,5,6,7]
+
+def test_flowlet_await_many():
+
+    @flowlet
+    def chunk(n):
+        while True:
+            send(await_many(n))
+
+    @flowlet
+    def source():
+        send_many(range(7))
+
+    line = source() >> chunk(3)
+
+    result = runPipeline(line)
+    assert result == [[0,1,2], [3,4,5], [6]]
+
+def test_flowlet_buffered():
+
+    @flowlet(buffer=4)
+    def M():
+        while True:
+            send(await() + 1)
+
+    line = xrange(10) >> M()
+
+    result = runPipeline(line)
+    assert result == range(1, 11)
+
+def test_flowlet_buffered_batches():
+
+    @flowlet(buffer=4)
+    def chunk():
+        while True:
+            send(await_many(4))
+
+    line = xrange(10) >> chunk()
+
+    result = runPipeline(line)
+    assert result == [[0,1,2,3], [4,5,6,7], [8,9]]
+
+def test_flowlet_buffered_after_flowlet():
+
+    @flowlet(buffer=4)
+    def chunk():
+        while True:
+            send(await_many(3))
+
+    # The upstream flowlet reads the source itself, what it ran ahead
+    # with is still delivered once the source runs out
+    line = xrange(10) >> pipe(lambda x: x) >> chunk()
+
+    result = runPipeline(line)
+    assert sum(result, []) == range(10)
+
 # =============
 # Associativity
 # =============
@@ -434,6 +504,172 @@ def test_robust_associativity3():
 
     assert r1 == r2
 
+# ======
+# Fusion
+# ======
+
+def test_fuse_plan():
+
+    line = [1,2,3] >> pipe(lambda x: x+1) >> pipe(lambda x: x*2) \
+        >> filter(lambda x: x > 4) >> take(5)
+
+    names = [stage.name for stage in plan(line)]
+    assert names == ['StrictPipe', 'pipe+pipe+filter', 'take']
+
+    names = [stage.name for stage in plan(line, fuse=False)]
+    assert names == ['StrictPipe', 'pipe', 'pipe', 'filter', 'take']
+
+def test_fuse_results():
+
+    line = xrange(10) >> pipe(lambda x: x+1) >> filter(lambda x: x % 3) \
+        >> pipe(lambda x: x*2)
+
+    assert runPipeline(line) == runPipeline(line, fuse=False)
+    assert runPipeline(line) == [2, 4, 8, 10, 14, 16, 20]
+
+def test_fuse_associativity():
+
+    a = [1,2,3]
+    b = pipe(lambda x: x+1)
+    c = pipe(lambda x: x*2)
+    d = take(2)
+
+    r1 = runPipeline(a >> b >> c >> d)
+    r2 = runPipeline(a >> (b >> (c >> d)))
+    r3 = runPipeline((a >> b) >> (c >> d))
+
+    assert r1 == r2 == r3 == [4, 6]
+
+def test_fuse_sink():
+
+    seen = []
+    line = [1,2,3] >> pipe(lambda x: x*10) >> pipe_(seen.append)
+
+    assert [s.name for s in plan(line)] == ['StrictPipe', 'pipe+pipe_']
+    assert runPipeline(line) == []
+    assert seen == [10, 20, 30]
+
+def test_fuse_only_stateless():
+
+    @flowlet
+    def double():
+        while True:
+            x = await()
+            send(x)
+            send(x)
+
+    line = [1,2] >> pipe(lambda x: x+1) >> double() >> pipe(lambda x: -x)
+
+    names = [stage.name for stage in plan(line)]
+    assert names == ['StrictPipe', 'pipe', 'double', 'pipe']
+    assert runPipeline(line) == [-2, -2, -3, -3]
+
+def test_fuse_standalone():
+    line = pipe(lambda x: x+1) >> pipe(lambda x: x*2)
+    assert len(plan(line)) == 1
+
+    result = runPipeline([1,2] >> line)
+    assert result == [4, 6]
+
+def test_flat_stages():
+    a, b, c = idLazy(), idLazy(), idLazy()
+    assert ((a >> b) >> c).stages == (a, b, c)
+    assert (a >> (b >> c)).stages == (a, b, c)
+
+def test_composite_links():
+    a, b, c = idLazy(), idLazy(), idLazy()
+    line = a >> b >> c
+
+    # Composing only links the two sides, the stages are flattened once
+    assert line.parts[1] is c
+    assert line.parts[0].parts == (a, b)
+    assert line.stages == (a, b, c)
+    assert line.name == '(%s)' % '.'.join([a.name] * 3)
+
+def test_deep_pipeline():
+    line = reduce(lambda x,y: x >> y, [idLazy() for i in xrange(2000)])
+    assert len(line.stages) == 2000
+
+    result = runPipeline([1,2,3] >> line)
+    assert result == [1, 2, 3]
+
+# ===========
+# Compilation
+# ===========
+
+def test_compiled_run():
+    line = pipe(lambda x: x+1) >> filter(lambda x: x % 2) >> pipe(lambda x: x*10)
+    compiled = compilePipeline(line)
+
+    assert compiled.run([1,2,3,4]) == [30, 50]
+    assert compiled.run(xrange(5)) == [10, 30, 50]
+    assert compiled.run([]) == []
+
+def test_compiled_iter():
+    compiled = compilePipeline(idLazy() >> pipe(lambda x: x*2) >> take(2))
+
+    assert list(compiled.iter([1,2,3])) == [2, 4]
+    assert list(compiled.iter(count(5))) == [10, 12]
+
+def test_compiled_source():
+    compiled = compilePipeline([1,2,3] >> pipe(lambda x: -x))
+    assert compiled.run() == [-1, -2, -3]
+    assert compiled.run() == [-1, -2, -3]
+
+def test_compiled_reuse():
+    from flowlet.flow import pool_stats
+
+    compiled = compilePipeline(pipe(lambda x: x+1) >> pipe_(lambda x: None),
+        fuse=False)
+    compiled.run([1,2,3])
+
+    before = pool_stats()
+    for i in xrange(10):
+        compiled.run([1,2,3])
+    after = pool_stats()
+
+    # Reruns neither create flowlets nor, when they are pooled, greenlets
+    assert after['flowlet_hits'] == before['flowlet_hits']
+    assert after['flowlet_misses'] == before['flowlet_misses']
+    if after['greenlet_pooling']:
+        assert after['greenlet_misses'] == before['greenlet_misses']
+
+def test_compiled_abandoned():
+    @flowlet
+    def numbers():
+        for i in count():
+            send(i)
+
+    compiled = compilePipeline(numbers() >> pipe(lambda x: x*2))
+    it = compiled.iter()
+
+    assert next(it) == 0
+    assert next(it) == 2
+
+    # A new run starts over even though the last was left suspended
+    it.close()
+    it = compiled.iter()
+    assert [next(it) for i in range(3)] == [0, 2, 4]
+
+    del it
+    it = compiled.iter()
+    assert next(it) == 0
+
+def test_compiled_in_flight():
+    compiled = compilePipeline(idLazy() >> pipe(lambda x: x*2))
+
+    it = compiled.iter([1,2,3])
+    assert next(it) == 2
+
+    # Would take over the run in flight
+    with assert_raises(RuntimeError):
+        compiled.iter([9,9])
+    with assert_raises(RuntimeError):
+        compiled.run([9,9])
+
+    assert list(it) == [4, 6]
+    assert list(compiled.iter([9,9])) == [18, 18]
+
 # ======
 # Purity
 # ======
@@ -839,6 +1075,16 @@ def test_forever():
     result = runPipeline(a >> b)
     assert result == ['fizzbar', 'fizzbar']
 
+# ======
+# filter
+# ======
+
+def test_filter():
+    line = xrange(7) >> filter(lambda x: x % 2 == 0)
+
+    result = runPipeline(line)
+    assert result == [0, 2, 4, 6]
+
 # =======
 # barrier
 # =======
@@ -1003,6 +1249,49 @@ def test_queue():
     result = runPipeline(a >> b)
     assert result == [1,2,3]
 
+def test_queue_batch():
+    from Queue import Queue
+    q = Queue()
+
+    for i in range(10):
+        q.put(i)
+
+    a = queuepipe(q, block=False, batch=4, emit='chunks')
+    result = runPipeline(a)
+    assert result == [[0,1,2,3], [4,5,6,7], [8,9]]
+
+    for i in range(10):
+        q.put(i)
+
+    a = queuepipe(q, block=False, batch=4)
+    result = runPipeline(a >> take(6))
+    assert result == [0,1,2,3,4,5]
+
+def test_queueput_batch():
+    from Queue import Queue
+    q = Queue()
+
+    runPipeline(range(5) >> queueput(q, batch=2))
+    items = [q.get() for _ in range(q.qsize())]
+    assert items == [[0,1], [2,3], [4]]
+
+    # Taken apart again on the other side
+    for item in items:
+        q.put(item)
+    assert runPipeline(queuepipe(q, block=False)) == range(5)
+
+def test_queueput_batch_none():
+    from Queue import Queue
+    q = Queue()
+
+    # A None among the values is not the end of the stream
+    runPipeline([None, 1, 2] >> queueput(q, batch=4))
+    assert [q.get() for _ in range(q.qsize())] == [[None, 1, 2]]
+
+    runPipeline([1, None] >> pipe(lambda x: x) >> queueput(q, batch=4))
+    items = [q.get() for _ in range(q.qsize())]
+    assert sum(items, []) == [1, None]
+
 # =====
 # Files
 # =====
@@ -1024,6 +1313,72 @@ def test_file_open_notneeded():
     result = runPipeline(a >> b)
     assert result == []
 
+def test_file_eof():
+    result = runPipeline(filepipe('example.txt'))
+    assert result == ['this is line %i\n' % i for i in (1,2,3)]
+
+    result = runPipeline(filepipe('example.txt') >> consume())
+    assert result == []
+
+def test_file_lines_across_chunks():
+    a = filepipe('example.txt', chunk_size=4)
+    b = pipe(lambda x: x)
+
+    result = runPipeline(a >> b)
+    assert result == ['this is line %i\n' % i for i in (1,2,3)]
+
+def test_file_chunks():
+    a = filepipe('example.txt', mode='chunks', chunk_size=10)
+
+    result = runPipeline(a)
+    assert all(len(chunk) <= 10 for chunk in result)
+    assert ''.join(result) == open('example.txt').read()
+
+def test_file_no_trailing_newline():
+    fd, fname = tempfile.mkstemp()
+    try:
+        os.write(fd, 'foo\nbar')
+        os.close(fd)
+        assert runPipeline(filepipe(fname, chunk_size=2)) == ['foo\n', 'bar']
+    finally:
+        os.remove(fname)
+
+def test_mmap_lines():
+    result = runPipeline(mmappipe('example.txt', batch=2))
+    assert all(type(line) is buffer for line in result)
+    assert map(str, result) == ['this is line %i' % i for i in (1,2,3)]
+
+def test_mmap_width():
+    fd, fname = tempfile.mkstemp()
+    try:
+        os.write(fd, 'aaabbbcc')
+        os.close(fd)
+        result = runPipeline(mmappipe(fname, width=3))
+        assert map(str, result) == ['aaa', 'bbb', 'cc']
+
+        result = runPipeline(mmappipe(fname, delimiter='bb'))
+        assert map(str, result) == ['aaa', 'bcc']
+    finally:
+        os.remove(fname)
+
+def test_mmap_empty():
+    fd, fname = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        assert runPipeline(mmappipe(fname)) == []
+    finally:
+        os.remove(fname)
+
+def test_mmap_invalid():
+    with assert_raises(ValueError):
+        runPipeline(mmappipe('example.txt', delimiter=''))
+    with assert_raises(ValueError):
+        runPipeline(mmappipe('example.txt', width=0))
+
+def test_file_mode_invalid():
+    with assert_raises(ValueError):
+        runPipeline(filepipe('example.txt', mode='words'))
+
 # -------
 # Flowlet
 # -------
@@ -1426,6 +1781,102 @@ def test_numexprpipe2():
     assert result[0].all()
     assert result[1].all()
 
+def test_numexprpipe_batch():
+    line = range(10) >> numexpr_pipe('x*2', batch=4)
+    result = runPipeline(line)
+
+    assert result == [2.0*i for i in range(10)]
+
+def test_numexprpipe_block():
+    line = range(10) >> numexpr_pipe('x*2', batch=4, emit='block')
+    result = runPipeline(line)
+
+    assert map(len, result) == [4, 4, 2]
+    assert sum(map(list, result), []) == [2.0*i for i in range(10)]
+
+def test_numexprpipe_records():
+    line = [(1,2), (3,4), (5,6)] >> numexpr_pipe('x-y*y', batch=8)
+    result = runPipeline(line)
+
+    assert result == [-3.0, -13.0, -31.0]
+
+def test_numexprpipe_cached():
+    from flowlet.prelude import numexpr_programs
+
+    runPipeline([1] >> numexpr_pipe('x+41'))
+    vm = numexpr_programs['x+41']
+    runPipeline([1] >> numexpr_pipe('x+41', batch=2))
+    assert numexpr_programs['x+41'] is vm
+
+def scaled(k):
+    while 1:
+        x = await()
+        send(x * k)
+
+def test_cythonpipe():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        line = [1,2,3] >> cythonpipe(scaled, cache_dir)(3)
+        assert runPipeline(line) == [3, 6, 9]
+        assert len(glob.glob(os.path.join(cache_dir, '*.so'))) == 1
+    finally:
+        shutil.rmtree(cache_dir)
+
+OFFSET_MODULE = '''
+from flowlet.flow import await, send
+
+K = %i
+
+def offset():
+    while 1:
+        send(await() + K)
+'''
+
+def test_cythonpipe_same_source():
+    cache_dir = tempfile.mkdtemp()
+    sys.path.insert(0, cache_dir)
+
+    try:
+        # The same function in two modules, with globals of their own
+        for name, k in (('offset_one', 1), ('offset_two', 2)):
+            with open(os.path.join(cache_dir, name + '.py'), 'w') as f:
+                f.write(OFFSET_MODULE % k)
+
+        import offset_one, offset_two
+        one = [1] >> cythonpipe(offset_one.offset, cache_dir)()
+        two = [1] >> cythonpipe(offset_two.offset, cache_dir)()
+        assert runPipeline(one) == [2]
+        assert runPipeline(two) == [3]
+    finally:
+        sys.path.remove(cache_dir)
+        shutil.rmtree(cache_dir)
+
+def test_cythonpipe_processes():
+    from multiprocessing import Pool
+    cache_dir = tempfile.mkdtemp()
+
+    try:
+        # Both compete to build the same module, only one does
+        pool = Pool(2)
+        names = pool.map(compile_shifted, [cache_dir] * 2)
+        pool.close()
+        pool.join()
+
+        assert names[0] == names[1]
+        assert len(glob.glob(os.path.join(cache_dir, '*.so'))) == 1
+        assert [f for f in os.listdir(cache_dir) if f.startswith('tmp')] == []
+    finally:
+        shutil.rmtree(cache_dir)
+
+def shifted(k):
+    while 1:
+        x = await()
+        send(x + k)
+
+def compile_shifted(cache_dir):
+    from flowlet.cythoncache import compiled
+    return compiled(shifted, cache_dir).__module__
+
 if __name__ == '__main__':
     import sys
     import nose